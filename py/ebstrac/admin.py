@@ -0,0 +1,151 @@
+# trac-admin commands for evidence-based scheduling.
+
+# Like the request handlers, each command takes the component as its
+# first argument, followed by the command-line arguments as strings.
+
+from datetime import timedelta
+import random
+
+from trac.admin import AdminCommandError
+
+import ebs
+import handlers
+import schema
+
+def parse_date(s):
+	try:
+		return handlers.string_to_date(s)
+	except ValueError:
+		raise AdminCommandError("Invalid date '%s', expected YYYY-MM-DD" % s)
+
+def holiday_list(com):
+	db = com.env.get_db_cnx()
+	cursor = db.cursor()
+	cursor.execute("SELECT day, name FROM ebs_holiday ORDER BY day")
+	for day, name in cursor.fetchall():
+		print "%s  %s" % (day, name or '')
+
+def holiday_add(com, day, name=None):
+	day = parse_date(day).strftime("%Y-%m-%d")
+	db = com.env.get_db_cnx()
+	cursor = db.cursor()
+	cursor.execute("DELETE FROM ebs_holiday WHERE day = %s", (day,))
+	cursor.execute("INSERT INTO ebs_holiday (day, name) VALUES (%s, %s)",
+	    (day, name))
+	db.commit()
+
+def holiday_remove(com, day):
+	day = parse_date(day).strftime("%Y-%m-%d")
+	db = com.env.get_db_cnx()
+	cursor = db.cursor()
+	cursor.execute("DELETE FROM ebs_holiday WHERE day = %s", (day,))
+	db.commit()
+
+def absence_days(first, last):
+	'''Workdays from first to last, inclusive, as 'YYYY-MM-DD' strings.'''
+
+	dt0 = parse_date(first)
+	dt1 = dt0
+	if last:
+		dt1 = parse_date(last)
+	if dt1 < dt0:
+		raise AdminCommandError("%s is before %s" % (last, first))
+	cal = ebs.WorkdayCalendar()
+	a = []
+	for n in range((dt1 - dt0).days + 1):
+		dt = dt0 + timedelta(n)
+		if cal.is_workday(dt):
+			a.append(dt.strftime("%Y-%m-%d"))
+	return a
+
+def absence_list(com, user=None):
+	db = com.env.get_db_cnx()
+	cursor = db.cursor()
+	sql = "SELECT username, day, hours FROM ebs_absence"
+	params = ()
+	if user:
+		sql += " WHERE username = %s"
+		params = (user,)
+	cursor.execute(sql + " ORDER BY username, day", params)
+	for user, day, hours in cursor.fetchall():
+		if hours:
+			print "%-10s %s  %.2f hours" % (user, day, hours)
+		else:
+			print "%-10s %s  all day" % (user, day)
+
+def absence_add(com, user, first, last=None, hours=None):
+	'''Book user off from first to last.  No hours means all day.'''
+
+	if hours is not None:
+		try:
+			hours = float(hours)
+		except ValueError:
+			raise AdminCommandError("Invalid hours '%s'" % hours)
+	db = com.env.get_db_cnx()
+	cursor = db.cursor()
+	for day in absence_days(first, last):
+		cursor.execute("DELETE FROM ebs_absence "
+		    "WHERE username = %s AND day = %s", (user, day))
+		cursor.execute("INSERT INTO ebs_absence (username, day, hours) "
+		    "VALUES (%s, %s, %s)", (user, day, hours))
+	db.commit()
+
+def absence_remove(com, user, first, last=None):
+	dt0 = parse_date(first).strftime("%Y-%m-%d")
+	dt1 = dt0
+	if last:
+		dt1 = parse_date(last).strftime("%Y-%m-%d")
+	db = com.env.get_db_cnx()
+	cursor = db.cursor()
+	cursor.execute("DELETE FROM ebs_absence "
+	    "WHERE username = %s AND day >= %s AND day <= %s", (user, dt0, dt1))
+	db.commit()
+
+def timecard_backfill(com):
+	'''Rebuild ebs_timecard from the hours in ticket_change.'''
+
+	db = com.env.get_db_cnx()
+	cursor = db.cursor()
+	n = schema.backfill_timecards(com.env, db, cursor)
+	db.commit()
+	print "%d timecard entries" % n
+
+def velocity_rebuild(com):
+	'''Rebuild ebs_velocity from the closed tickets.'''
+
+	db = com.env.get_db_cnx()
+	cursor = db.cursor()
+	n = schema.rebuild_velocity(com.env, db, cursor)
+	db.commit()
+	print "%d closed tickets" % n
+
+def index_check(com):
+	'''List the indexes from schema.indexes that are missing.'''
+
+	db = com.env.get_db_cnx()
+	if schema.get_indexes(com.env, db) is None:
+		raise AdminCommandError("Can't check indexes on this database.")
+	missing = schema.missing_indexes(com.env, db)
+	for name, table, columns in missing:
+		print "missing %s on %s (%s)" % (name, table, ", ".join(columns))
+	if not missing:
+		print "All indexes present."
+
+def forecast(com, *milestones):
+	'''Forecast milestones; a last argument of seed=N sets the seed.'''
+
+	seed = random.randrange(2 ** 31)
+	if milestones and milestones[-1].startswith('seed='):
+		try:
+			seed = int(milestones[-1][5:])
+		except ValueError:
+			raise AdminCommandError("Invalid %s" % milestones[-1])
+		milestones = milestones[:-1]
+	db = com.env.get_db_cnx()
+	if not milestones:
+		milestones = handlers.lookup_active_milestones(db)
+	if not milestones:
+		raise AdminCommandError("No open milestones.")
+	a = handlers.shipdates_report(com, None, db, milestones, {}, seed)
+	for line in a:
+		print line
@@ -0,0 +1,196 @@
+# A cache of finished reports.
+
+from datetime import date
+from hashlib import sha1
+import cPickle as pickle
+import os
+import tempfile
+import threading
+
+class ReportCache(object):
+	'''
+	Least-recently-used cache of finished reports.  Ship dates are
+	counted from today, so an entry is only good for the day it was
+	made.  (The trials kept from one ship date report to the next
+	are in one of these too, in memory, so they can't grow without
+	bound either.)
+
+		>>> from datetime import date
+		>>> monday, tuesday = date(2010, 9, 6), date(2010, 9, 7)
+		>>> c = ReportCache(2)
+		>>> c.put('a', 'report a', monday)
+		>>> c.put('b', 'report b', monday)
+		>>> c.get('a', monday)
+		'report a'
+
+	Adding a third entry pushes out the one used longest ago.
+
+		>>> c.put('c', 'report c', monday)
+		>>> c.get('b', monday) is None
+		True
+		>>> c.get('a', monday), c.get('c', monday)
+		('report a', 'report c')
+
+	The next day, everything is stale.
+
+		>>> c.get('a', tuesday) is None
+		True
+
+	Given a directory, entries are also kept there as files, one per
+	key, so that other processes (say, FastCGI workers) can use them.
+
+		>>> import tempfile, shutil
+		>>> d = tempfile.mkdtemp()
+		>>> ReportCache(2, d).put(('Event Demo', 42), 'report', monday)
+		>>> ReportCache(2, d).get(('Event Demo', 42), monday)
+		'report'
+		>>> ReportCache(2, d).get(('Event Demo', 43), monday) is None
+		True
+		>>> shutil.rmtree(d)
+	'''
+
+	def __init__(self, size, directory=None):
+		self.size = size
+		self.directory = directory
+		self.entries = {}
+		# keys, the least recently used first
+		self.order = []
+		self.lock = threading.Lock()
+
+	def get(self, key, today=None):
+		'''The value for key, or None if we don't have it for today.'''
+
+		if today is None:
+			today = date.today()
+		self.lock.acquire()
+		try:
+			if self.entries.has_key(key):
+				day, value = self.entries[key]
+				self.order.remove(key)
+				if day == today:
+					self.order.append(key)
+					return value
+				del self.entries[key]
+		finally:
+			self.lock.release()
+
+		if self.directory:
+			entry = self._read(key)
+			if entry and entry[0] == today:
+				self._remember(key, entry)
+				return entry[1]
+		return None
+
+	def pop(self, key, today=None):
+		'''
+		Like get(), but take the entry out of memory, so nobody else
+		gets it until it is put back.  (A copy on disk stays there.)
+
+			>>> from datetime import date
+			>>> c = ReportCache(2)
+			>>> c.put('a', 'trials a', date(2010, 9, 6))
+			>>> c.pop('a', date(2010, 9, 6))
+			'trials a'
+			>>> c.pop('a', date(2010, 9, 6)) is None
+			True
+		'''
+
+		value = self.get(key, today)
+		if value is not None:
+			self.lock.acquire()
+			try:
+				if self.entries.has_key(key):
+					del self.entries[key]
+					self.order.remove(key)
+			finally:
+				self.lock.release()
+		return value
+
+	def put(self, key, value, today=None):
+		if self.size <= 0:
+			return
+		if today is None:
+			today = date.today()
+		entry = (today, value)
+		self._remember(key, entry)
+		if self.directory:
+			self._write(key, entry)
+
+	def _remember(self, key, entry):
+		self.lock.acquire()
+		try:
+			if self.entries.has_key(key):
+				self.order.remove(key)
+			self.entries[key] = entry
+			self.order.append(key)
+			while len(self.order) > self.size:
+				del self.entries[self.order.pop(0)]
+		finally:
+			self.lock.release()
+
+	#
+	# On disk, each entry is a pickle of (key, day, value) in a file
+	# named for a hash of the key.  A file is written under a
+	# temporary name and renamed into place, so a reader never sees
+	# half of one.  Reading a file touches it, and when there are too
+	# many files the ones touched longest ago are removed.
+	#
+	# It's only a cache, so if anything goes wrong with the files we
+	# carry on without them.
+	#
+
+	def _path(self, key):
+		return os.path.join(self.directory, sha1(repr(key)).hexdigest())
+
+	def _read(self, key):
+		path = self._path(key)
+		try:
+			f = open(path, 'rb')
+			try:
+				k, day, value = pickle.load(f)
+			finally:
+				f.close()
+			os.utime(path, None)
+		except (EnvironmentError, EOFError, ValueError,
+		    pickle.UnpicklingError):
+			return None
+		if k != key:
+			return None
+		return day, value
+
+	def _write(self, key, entry):
+		try:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			fd, tmp = tempfile.mkstemp(dir=self.directory,
+			    prefix='.tmp')
+			f = os.fdopen(fd, 'wb')
+			try:
+				pickle.dump((key,) + entry, f, 2)
+			finally:
+				f.close()
+			os.rename(tmp, self._path(key))
+			self._trim()
+		except EnvironmentError:
+			pass
+
+	def _trim(self):
+		a = []
+		for name in os.listdir(self.directory):
+			if name.startswith('.tmp'):
+				continue
+			path = os.path.join(self.directory, name)
+			try:
+				a.append((os.path.getmtime(path), path))
+			except OSError:
+				pass
+		a.sort()
+		for mtime, path in a[:max(0, len(a) - self.size)]:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -2,9 +2,22 @@
 Evidence-based scheduling routines.
 '''
 
+from array import array
+from bisect import bisect_left, bisect_right
+from hashlib import md5
 from datetime import timedelta, date
+from math import ceil
+from time import time
+import multiprocessing
 import random
 
+# NumPy is optional.  Without it, we run the Monte Carlo simulation
+# in the plain Python loop.
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 def count_workdays(dt0, dt1, daysoff=(5,6)):
 	'''
 	Return the all weekdays between and including the two dates.
@@ -58,34 +71,289 @@ def advance_n_workdays(dt0, n, daysoff = (5,6)):
 		datetime.date(2010, 9, 7)
 	'''
 
-	#
-	# We start counting on the first work day.  If the start date
-	# passed in is not a work day, then advance to the first one.
-	#
+	return WorkdayCalendar(daysoff).advance(dt0, n)
 
-	looplimit = 8
-	i = 0
-	while dt0.weekday() in daysoff:
-		i += 1
-		dt0 += timedelta(1)
-		if i > looplimit:
-			raise ValueError("Logic error, looping forever.")
+class WorkdayCalendar(object):
+	'''
+	Workday arithmetic that does not step through the calendar one
+	day at a time.
 
+	Days off repeat every week, so we count whole weeks with one
+	multiplication and handle the remainder with a small table.
+	Holidays are kept in a sorted list, and we bisect it to find how
+	many fall in a date range.
 
-	day_n = 1
-	workday_n = 0
-	while workday_n < n:
-		d = dt0 + timedelta(day_n)
-		if d.weekday() not in daysoff:
-			workday_n += 1
-		day_n += 1
+			   September 2010   
+			Su Mo Tu We Th Fr Sa
+				  1  2  3  4
+			 5  6  7  8  9 10 11
+			12 13 14 15 16 17 18
+			19 20 21 22 23 24 25
+			26 27 28 29 30      
+
+		>>> from datetime import date
+		>>> cal = WorkdayCalendar(holidays = [date(2010, 9, 6)])
+		>>> cal.count(date(2010, 9, 1), date(2010, 9, 30))
+		21
+		>>> cal.advance(date(2010, 9, 3), 1)
+		datetime.date(2010, 9, 7)
+		>>> cal.advance(date(2010, 9, 3), 2.5)
+		datetime.date(2010, 9, 9)
+
+	Holidays that fall on a day off don't change anything.
+
+		>>> cal = WorkdayCalendar(holidays = [date(2010, 9, 4)])
+		>>> cal.holidays
+		[]
+
+	Absences are per dev: a dictionary that maps each dev to a
+	dictionary of {date: hours_off}, where None means the whole day.
+	They only matter through capacity(), which builds a CapacityIndex
+	for one dev.
+	'''
+
+	def __init__(self, daysoff=(5,6), holidays=(), absences=None):
+		self.absences = absences or {}
+		self.daysoff = tuple(sorted(set(daysoff)))
+		self.weekdays = [d for d in range(7) if d not in self.daysoff]
+		if not self.weekdays:
+			raise ValueError("every day of the week is a day off")
+		self.holidays = sorted(set(
+		    [d for d in holidays if d.weekday() not in self.daysoff]))
+
+		# before[k] is the number of workdays in a week that come
+		# before weekday k (Monday is 0).
+		self.before = []
+		n = 0
+		for k in range(7):
+			self.before.append(n)
+			if k not in self.daysoff:
+				n += 1
+
+	def _weekdays_before(self, dt):
+		'''
+		Number of workdays, ignoring holidays, from date.min up to
+		but not including dt.  (date.min is a Monday.)
+		'''
+
+		weeks, k = divmod(dt.toordinal() - 1, 7)
+		return weeks * len(self.weekdays) + self.before[k]
+
+	def _nth_weekday(self, n):
+		'''Inverse of _weekdays_before(): the n'th (zero-based)
+		workday, ignoring holidays, counting from date.min.'''
+
+		weeks, k = divmod(n, len(self.weekdays))
+		return date.fromordinal(1 + weeks * 7 + self.weekdays[k])
+
+	def _holidays_between(self, dt0, dt1):
+		'''Number of holidays h with dt0 <= h <= dt1.'''
+
+		return bisect_right(self.holidays, dt1) \
+		    - bisect_left(self.holidays, dt0)
+
+	def is_workday(self, dt):
+		return dt.weekday() not in self.daysoff \
+		    and not self._holidays_between(dt, dt)
+
+	def count(self, dt0, dt1):
+		'''Number of workdays between and including the two dates.'''
+
+		if dt1 < dt0:
+			return 0
+		n = self._weekdays_before(dt1 + timedelta(1)) \
+		    - self._weekdays_before(dt0)
+		return n - self._holidays_between(dt0, dt1)
+
+	def first(self, dt0):
+		'''The first workday on or after dt0.'''
+
+		dt = self._nth_weekday(self._weekdays_before(dt0))
+		while self._holidays_between(dt, dt):
+			dt = self._nth_weekday(self._weekdays_before(dt) + 1)
+		return dt
+
+	def advance(self, dt0, n):
+		'''
+		Count forward n work days, the same way advance_n_workdays()
+		does: start on the first workday on or after dt0, and round a
+		fractional n up to the next whole day.
+		'''
+
+		dt0 = self.first(dt0)
+		n = int(ceil(n))
+		if n <= 0:
+			return dt0
+
+		#
+		# Jump ahead n workdays as if there were no holidays, then
+		# push the date out by the holidays we jumped over.  Those
+		# extra days can land on more holidays, so repeat until we
+		# stop finding new ones.
+		#
+
+		i0 = self._weekdays_before(dt0)
+		skipped = 0
+		while True:
+			dt = self._nth_weekday(i0 + n + skipped)
+			h = self._holidays_between(dt0 + timedelta(1), dt)
+			if h == skipped:
+				return dt
+			skipped = h
+
+	def capacity(self, dev, startdt, dailyhours):
+		'''Return the CapacityIndex for dev, starting at startdt.'''
+
+		return CapacityIndex(self, startdt, self.absences.get(dev),
+		    dailyhours)
+
+class CapacityIndex(object):
+	'''
+	Cumulative work capacity for one dev, in labor days, for each day
+	after a start date.
+
+	A normal workday adds one labor day, a holiday or a day of
+	vacation adds nothing, and a partial absence adds whatever
+	fraction of the dev's usual hours is left.  Since the array only
+	goes up, we find the date a dev finishes a given amount of work
+	with a binary search instead of walking the calendar.
 
-	return  dt0 + timedelta(day_n - 1)
+			   September 2010   
+			Su Mo Tu We Th Fr Sa
+				  1  2  3  4
+			 5  6  7  8  9 10 11
+			12 13 14 15 16 17 18
+			19 20 21 22 23 24 25
+			26 27 28 29 30      
+
+	Mark works four hours a day, but is off on the 7th, and takes the
+	afternoon of the 8th off.
 
-def availability_from_timecards(timecards):
+		>>> from datetime import date
+		>>> absences = {date(2010, 9, 7): None, date(2010, 9, 8): 2.0}
+		>>> cap = CapacityIndex(WorkdayCalendar(), date(2010, 9, 3),
+		...     absences, 4.0)
+		>>> cap.cum[:6]
+		[0.0, 0.0, 0.0, 1.0, 1.0, 1.5]
+		>>> cap.finish_dates([0, 1, 1.5, 2])
+		[datetime.date(2010, 9, 3), datetime.date(2010, 9, 6), datetime.date(2010, 9, 8), datetime.date(2010, 9, 9)]
+
+	Without absences, we agree with advance_n_workdays().
+
+		>>> cap = CapacityIndex(WorkdayCalendar(), date(2010, 9, 4))
+		>>> cap.finish_date(1) == advance_n_workdays(date(2010, 9, 4), 1)
+		True
+	'''
+
+	def __init__(self, calendar, startdt, absences=None, dailyhours=None):
+		self.calendar = calendar
+		self.absences = absences or {}
+		self.dailyhours = dailyhours
+
+		# Like advance_n_workdays(), work starts on the first day
+		# on or after startdt that the dev can actually work.
+		dt = calendar.first(startdt)
+		while self.capacity_on(dt) <= 0.0:
+			dt = calendar.first(dt + timedelta(1))
+		self.start = dt
+
+		self.cum = [0.0]
+		self._grow(64)
+
+	def capacity_on(self, dt):
+		'''Labor days the dev can put in on dt.'''
+
+		if not self.calendar.is_workday(dt):
+			return 0.0
+		if not self.absences.has_key(dt):
+			return 1.0
+		hours = self.absences[dt]
+		if not hours or not self.dailyhours:
+			return 0.0
+		return max(0.0, 1.0 - hours / float(self.dailyhours))
+
+	def _grow(self, n):
+		'''Add n more days to the end of the cumulative array.'''
+
+		total = self.cum[-1]
+		dt = self.start + timedelta(len(self.cum))
+		for i in range(n):
+			total += self.capacity_on(dt)
+			self.cum.append(total)
+			dt += timedelta(1)
+
+	def _cover(self, labordays):
+		'''Make sure the array reaches labordays.'''
+
+		if labordays != labordays or labordays == float('inf'):
+			raise ValueError("can't schedule %s labor days" % (labordays,))
+		while self.cum[-1] < labordays:
+			self._grow(len(self.cum))
+
+	def finish_day(self, labordays):
+		'''Days after start on which labordays of work is done.'''
+
+		self._cover(labordays)
+		return bisect_left(self.cum, labordays)
+
+	def finish_days(self, labordays):
+		'''Vectorized finish_day(); returns an array with NumPy.'''
+
+		if numpy is not None:
+			a = numpy.asarray(labordays, dtype=float)
+			if len(a):
+				self._cover(a.max())
+			return numpy.searchsorted(self.cum, a, side='left')
+		return [self.finish_day(x) for x in labordays]
+
+	def finish_date(self, labordays):
+		return self.start + timedelta(self.finish_day(labordays))
+
+	def finish_dates(self, labordays):
+		return [self.start + timedelta(int(n))
+		    for n in self.finish_days(labordays)]
+
+def shipdates_from_labordays(dev_to_capacity, dev_to_daysleftlist, trials_n):
+	'''
+	The ship date for each trial is the day the last dev finishes.
+
+	Each dev has their own CapacityIndex, so with vacations in the
+	mix we have to take the max across devs in calendar days, not in
+	labor days.
+	'''
+
+	if numpy is not None:
+		last = numpy.zeros(trials_n, dtype=int)
+		for dev, capacity in dev_to_capacity.items():
+			days = capacity.finish_days(dev_to_daysleftlist[dev])
+			last = numpy.maximum(last, capacity.start.toordinal() + days)
+		last = last.tolist()
+	else:
+		last = [0] * trials_n
+		for dev, capacity in dev_to_capacity.items():
+			days = capacity.finish_days(dev_to_daysleftlist[dev])
+			start = capacity.start.toordinal()
+			for i, n in enumerate(days):
+				if start + n > last[i]:
+					last[i] = start + n
+
+	ordinal_to_date = {}
+	shipdates = []
+	for n in last:
+		try:
+			shipdates.append(ordinal_to_date[n])
+		except KeyError:
+			ordinal_to_date[n] = date.fromordinal(n)
+			shipdates.append(ordinal_to_date[n])
+	return shipdates
+
+def availability_from_timecards(timecards, calendar=None):
 	'''
 	Compute average hours available per weekday per dev.
 
+	If a WorkdayCalendar is given, its holidays don't count as days
+	the dev could have worked.
+
 			   September 2010   
 			Su Mo Tu We Th Fr Sa
 				  1  2  3  4
@@ -131,11 +399,13 @@ def availability_from_timecards(timecards):
 		except KeyError:
 			totalhours[dev] = hours
 
+	if calendar is None:
+		calendar = WorkdayCalendar()
 	averages = {}
 	for dev in totalhours.keys():
 		dt0 = firstday[dev]
 		dt1 = lastday[dev]
-		n = len(list(count_workdays(dt0, dt1)))
+		n = calendar.count(dt0, dt1)
 		if n > 0:
 			averages[dev] = totalhours[dev]/float(n)
 
@@ -164,6 +434,25 @@ def history_to_dict(history):
 		d[dev].append(velocity)
 	return d
 
+def tally(list, count=None):
+	'''
+	Count how often each element of list occurs.  Adds to the given
+	{element: count} dictionary, if any, so a histogram can be built
+	up one batch at a time.
+
+		>>> sorted(tally( (3, 1, 1), {1: 1, 2: 1} ).items())
+		[(1, 3), (2, 1), (3, 1)]
+	'''
+
+	if count is None:
+		count = {}
+	for x in list:
+		try:
+			count[x] += 1
+		except KeyError:
+			count[x] = 1
+	return count
+
 def list_to_pdf(list):
 	'''
 	Given a list dates, return the probability density function.
@@ -175,14 +464,18 @@ def list_to_pdf(list):
 		((1, 50), (2, 75), (3, 100))
 	'''
 
-	trials_n = len(list)
+	return counts_to_pdf(tally(list))
+
+def counts_to_pdf(count):
+	'''
+	Same as list_to_pdf(), but from a {element: count} histogram.
+
+		>>> counts_to_pdf( {3: 1, 1: 2, 2: 1} )
+		((1, 50), (2, 75), (3, 100))
+	'''
+
+	trials_n = sum(count.values())
 
-	count = {}
-	for x in list:
-		try:
-			count[x] += 1
-		except KeyError:
-			count[x] = 1
 	a = []
 	for x, n in count.items():
 		a.append( (x,  n / float(trials_n)) )
@@ -202,15 +495,63 @@ def percentile(a, p):
 
 		>>> percentile( (1,2,3), 0.50)
 		2
+
+	The list must be sorted; see percentiles() for lists that aren't.
 	'''
 
-	n = len(a)
+	return percentiles(a, (p,), True)[0]
+
+def percentile_ranks(n, p):
+	'''
+	The (zero-based) positions in a sorted list of n elements that we
+	average to get the p'th percentile; see quartiles() for the
+	method.  The 0'th and 100'th percentiles are the min and max.
+
+		>>> percentile_ranks(6, 0.25), percentile_ranks(6, 0.50)
+		((1,), (2, 3))
+	'''
+
+	if p <= 0.0:
+		return (0,)
+	if p >= 1.0:
+		return (n - 1,)
 	i = int(n * p)
 	if abs((n * p) - i) < 0.000001:
-		q = (a[i] + a[i - 1]) / 2.
+		return (i - 1, i)
+	return (i,)
+
+def percentiles(a, ps, is_sorted=False):
+	'''
+	Return the percentile() of a for each p in ps, in one go.
+
+	Unless is_sorted, we sort a copy of a once; or, with NumPy and a
+	long list (or any array), we use partial selection to find just
+	the elements we need.  Either way, the answers are the same.
+
+		>>> percentiles( (5, 1, 4, 2, 3, 6), (0, 0.25, 0.50, 0.75, 1) )
+		(1, 2, 3.5, 5, 6)
+	'''
+
+	n = len(a)
+	ranks = [percentile_ranks(n, p) for p in ps]
+
+	if is_sorted:
+		pass
+	elif numpy is not None and (n >= 1000 or
+	    isinstance(a, numpy.ndarray)):
+		want = sorted(set([i for r in ranks for i in r]))
+		a = numpy.partition(numpy.asarray(a), want)
+		a = dict(zip(want, a[want].tolist()))
 	else:
-		q = a[i]
-	return q
+		a = sorted(a)
+
+	q = []
+	for r in ranks:
+		if len(r) == 2:
+			q.append((a[r[1]] + a[r[0]]) / 2.)
+		else:
+			q.append(a[r[0]])
+	return tuple(q)
 	
 def quartiles(a):
 	'''
@@ -283,9 +624,123 @@ def quartiles(a):
 		(1, 1.5, 2)
 	'''
 
-	return percentile(a, 0.25), percentile(a, 0.50), percentile(a, 0.75)
+	return percentiles(a, (0.25, 0.50, 0.75), True)
 	
-def devquartiles_from_labordays(dev_labordays, trials_n):
+class QuantileSketch(object):
+	'''
+	A fixed-size summary of a stream of numbers, good enough to answer
+	percentile() questions without keeping the numbers around.
+
+	We keep (value, count) centroids, sorted by value.  As long as no
+	more than size distinct values have been added, the centroids are
+	an exact histogram and so are the percentiles.
+
+		>>> s = QuantileSketch(size = 4)
+		>>> s.add( (1, 2, 3) )
+		>>> s.add( (3, 4) )
+		>>> s.centroids()
+		[(1, 1), (2, 1), (3, 2), (4, 1)]
+		>>> s.quartiles() == quartiles( (1, 2, 3, 3, 4) )
+		True
+
+	Once there are more, neighbouring centroids are merged into their
+	weighted mean, with no centroid holding much more than 1/size of
+	the values.  From then on the percentiles are approximate (off
+	by roughly 1/size in rank) but memory stays the same no matter
+	how many values go in: never more than twice size centroids,
+	plus one batch.  The min and max are always exact.
+
+		>>> s.add( (5, 6, 7, 8) )
+		>>> s.centroids()
+		[(1.5, 2), (3, 2), (4.5, 2), (6.5, 2), (8, 1)]
+		>>> s.min, s.max
+		(1, 8)
+	'''
+
+	def __init__(self, size=200):
+		self.size = size
+		self.values = []
+		self.counts = []
+		self.n = 0
+		self.min = None
+		self.max = None
+
+	def centroids(self):
+		return zip(self.values, self.counts)
+
+	def add(self, values):
+		'''Add a batch of values.'''
+
+		count = tally(values, dict(self.centroids()))
+		if not count:
+			return
+		a = sorted(count.items())
+		if self.min is None or a[0][0] < self.min:
+			self.min = a[0][0]
+		if self.max is None or a[-1][0] > self.max:
+			self.max = a[-1][0]
+		self.n = sum(count.values())
+		self.values = [x for x, n in a]
+		self.counts = [n for x, n in a]
+		if len(self.values) > self.size:
+			self._compress()
+
+	def _compress(self):
+		#
+		# One pass, left to right: keep adding centroids to the
+		# current one until it would hold more than n/size values.
+		# Any two neighbours then hold more than that between them,
+		# so we end up with at most 2 * size centroids.
+		#
+
+		limit = float(self.n) / self.size
+		values = []
+		counts = []
+		total = 0.0
+		for x, n in self.centroids():
+			if counts and counts[-1] + n <= limit:
+				total += x * n
+				counts[-1] += n
+				values[-1] = total / counts[-1]
+			else:
+				total = float(x) * n
+				values.append(x)
+				counts.append(n)
+		self.values = values
+		self.counts = counts
+
+	def percentiles(self, ps):
+		'''Same as percentiles(), on the values added so far.'''
+
+		ranks = [percentile_ranks(self.n, p) for p in ps]
+
+		# One walk through the centroids finds every rank we need.
+		value_at = {}
+		want = sorted(set([i for r in ranks for i in r]))
+		seen = 0
+		for x, n in self.centroids():
+			seen += n
+			while want and want[0] < seen:
+				value_at[want.pop(0)] = x
+		for i in want:
+			value_at[i] = self.values[-1]
+
+		q = []
+		for r in ranks:
+			if len(r) == 2:
+				q.append((value_at[r[1]] + value_at[r[0]]) / 2.)
+			else:
+				q.append(value_at[r[0]])
+		return tuple(q)
+
+	def percentile(self, p):
+		return self.percentiles((p,))[0]
+
+	def quartiles(self):
+		return self.percentiles((0.25, 0.50, 0.75))
+
+def devquartiles_from_labordays(dev_labordays, trials_n, calendar=None,
+    dev_to_dailyworkhours=None):
 	'''
 	Compute descriptive statistics for each developer's ship date.
 
@@ -304,18 +759,44 @@ def devquartiles_from_labordays(dev_labordays, trials_n):
 
 	Note that the input to this routine is labordays so we can
 	compute descriptive stats without worrying about days off.
-	Once we have the stats, we convert to working days.
+	Once we have the stats, we convert to working days with each
+	dev's capacity in the given WorkdayCalendar (weekends off if
+	None).  The daily work hours are only needed to turn partial
+	absences into a fraction of a day.
+
+	A dev's labordays can also be a QuantileSketch instead of a list.
 	'''
 
-	seconds_per_halfday = 60 * 60 * 24 / 2
-	rval = []
+	dev_to_stats = {}
 	for dev, labordays in dev_labordays.items():
-		pdf = list_to_pdf(labordays)
-		min = pdf[0][0]
-		max = pdf[-1][0]
+		if isinstance(labordays, QuantileSketch):
+			q1, q2, q3 = labordays.quartiles()
+			dev_to_stats[dev] = (labordays.min, q1, q2, q3,
+			    labordays.max)
+			continue
+		dev_to_stats[dev] = percentiles(labordays,
+		    (0.0, 0.25, 0.50, 0.75, 1.0))
+
+	return devquartiles_from_stats(dev_to_stats, calendar,
+	    dev_to_dailyworkhours)
+
+def devquartiles_from_stats(dev_to_stats, calendar=None,
+    dev_to_dailyworkhours=None):
+	'''
+	Turn each dev's (min, q1, q2, q3, max) labordays into ship dates;
+	see devquartiles_from_labordays().
+	'''
+
+	if calendar is None:
+		calendar = WorkdayCalendar()
+	if dev_to_dailyworkhours is None:
+		dev_to_dailyworkhours = {}
 
-		daysleft = [daysleft for daysleft, density in pdf]
-		td1, td2, td3 = map(timedelta, quartiles(daysleft))
+	today = date.today()
+	seconds_per_halfday = 60 * 60 * 24 / 2
+	rval = []
+	for dev, (min, q1, q2, q3, max) in dev_to_stats.items():
+		td1, td2, td3 = map(timedelta, (q1, q2, q3))
 
 		#
 		# Adding a timedelta of 82,800 seconds (23 hours worth)
@@ -337,56 +818,71 @@ def devquartiles_from_labordays(dev_labordays, trials_n):
 		# terms of shipping date.
 		#
 
-		today = date.today()
-		min = advance_n_workdays(today, min)
-		q1 = advance_n_workdays(today, td1.days)
-		q2 = advance_n_workdays(today, td2.days)
-		q3 = advance_n_workdays(today, td3.days)
-		max = advance_n_workdays(today, max)
+		capacity = calendar.capacity(dev, today,
+		    dev_to_dailyworkhours.get(dev))
+		min, q1, q2, q3, max = capacity.finish_dates(
+		    (min, td1.days, td2.days, td3.days, max))
 
 		rval.append( (dev, min, q1, q2, q3, max), )
 
 	return tuple(rval)
 	
 
-def history_to_plotdata(history, todo, dev_to_dailyworkhours):
+def stream_seed(seed, dev, batch_i):
 	'''
-	History is a list of 
+	Seed for the random stream one dev uses in one batch of trials.
 
-		(dev, ticket, estimated_hours, actual_hours, velocity)
+	Every (seed, dev, batch) gets its own stream, so a dev's draws
+	don't depend on who else is on the milestone, and batches can run
+	anywhere (in any order) and still give the same answer.  We hash
+	with MD5 rather than hash() so the value is the same on every
+	platform.
 
-	tuples.
-
-	Todo is a list of (dev, ticket, est_hrs, act_hrs, todo_hrs)
-	tuples.
-
-	Timecards is a list of (dev, date, total_hours) tuples.  One
-	entry for each unique dev/date combination.
+		>>> stream_seed(42, 'mark', 0)
+		469649926L
+	'''
 
-	Given this data, we run 1,000 rounds of a Monte Carlo simulation.
-	Each round generates one ship date.  We take all 1,000 ship dates,
-	and generate two sets of coordinates:
+	s = md5("%s\0%s\0%d" % (seed, dev, batch_i)).hexdigest()
+	return long(s[:8], 16)
 
-		1. a probability density function for ship date, and
+def dev_random(seed, dev, batch_i):
+	'''A random.Random for the dev's stream, or an unseeded one.'''
 
-		2. box and whisker plots for each developer's ship date.
+	if seed is None:
+		return random.Random()
+	return random.Random(stream_seed(seed, dev, batch_i))
 
-	We use the timecard data to get an estimate of how many hours
-	each developer is available per week.
+def dev_randomstate(seed, dev, batch_i):
+	'''
+	A numpy.random.RandomState for the dev's stream, or an unseeded
+	one.  Seeded with a one-element array, it draws exactly the same
+	numbers as dev_random(), so both engines agree for a given seed.
+	'''
 
-		XXX: To model vacations, available hours should be in DB.
+	if seed is None:
+		return numpy.random.RandomState()
+	return numpy.random.RandomState([stream_seed(seed, dev, batch_i)])
 
-	See ebs.txt for the unit tests.
+def labordays_from_loop(dev_to_velocities, todo, dev_to_dailyworkhours,
+    trials_n, seed=None, batch_i=0):
 	'''
+	Run the Monte Carlo trials one at a time.
 
+	Return a (labordays_till_done, dev_to_daysleftlist) tuple, where the
+	first element holds the labor days left for the milestone in each
+	trial, and the second maps each dev to their labor days left in
+	each trial.
 
-	dev_to_velocities = history_to_dict(history)
+	Each dev draws velocities from their own stream (see
+	stream_seed()); if seed is None, the streams are not seeded.
+	'''
 
-	# How many Markov trials do we run.
-	trials_n = 1000
+	dev_to_random = {}
+	for dev, ticket, est, act, left in todo:
+		if not dev_to_random.has_key(dev):
+			dev_to_random[dev] = dev_random(seed, dev, batch_i)
 
-	startdt = date.today()
-	shipdates = []
+	labordays_till_done = []
 	dev_to_daysleftlist = {}
 	for trial_i in range(trials_n):
 
@@ -400,10 +896,7 @@ def history_to_plotdata(history, todo, dev_to_dailyworkhours):
 			if est < 0.00001:
 				continue
 
-			# velocity = est/actual.
-			# new est. = est / v
-			v = random.choice(dev_to_velocities[dev])
-			hrsleft = (est - act)/v
+			velocities = dev_to_velocities[dev]
 
 			#
 			# If someone has booked more time than estimated
@@ -415,9 +908,19 @@ def history_to_plotdata(history, todo, dev_to_dailyworkhours):
 			# may be very close to done, or they may not.  It's
 			# much simpler (and easier to explain) that we just
 			# skip these.
+			#
+			# Velocities are always positive, so we can tell
+			# before we draw one, and we don't waste a draw
+			# from the dev's stream.
 			# 
-			if hrsleft < 0.0:
+			if est - act < 0.0:
 				continue
+
+			# velocity = est/actual.
+			# new est. = est / v
+			v = dev_to_random[dev].choice(velocities)
+			hrsleft = (est - act)/v
+
 			try:
 				dev_to_hrsleft[dev] += hrsleft
 			except KeyError:
@@ -434,7 +937,480 @@ def history_to_plotdata(history, todo, dev_to_dailyworkhours):
 			dev_to_daysleftlist[dev].append(daysleft)
 
 		# Find max # of work days left across all devs.
-		labordays_till_done = max(dev_to_daysleft.values())
+		labordays_till_done.append(max(dev_to_daysleft.values()))
+
+	return labordays_till_done, dev_to_daysleftlist
+
+def labordays_from_matrix(dev_to_velocities, todo, dev_to_dailyworkhours,
+    trials_n, seed=None, batch_i=0):
+	'''
+	Run all the Monte Carlo trials at once with NumPy.
+
+	Same inputs and return value as labordays_from_loop().  Instead of
+	one random.choice() per ticket per trial, each dev draws a (trials
+	x tickets) matrix of velocities from their own stream, sums across
+	their tickets, and we take the max across devs for every trial in
+	one step.
+	'''
+
+	#
+	# Velocities are always positive, so a ticket's hours left are
+	# negative exactly when act > est.  We can drop those tickets (and
+	# tickets with no estimate) up front instead of per trial.
+	#
+
+	devs = []
+	dev_to_remaining = {}
+	for dev, ticket, est, act, left in todo:
+		if est < 0.00001:
+			continue
+		# Same KeyError as the loop for a dev with no history.
+		dev_to_velocities[dev]
+		if est - act < 0.0:
+			continue
+		if not dev_to_remaining.has_key(dev):
+			devs.append(dev)
+			dev_to_remaining[dev] = []
+		dev_to_remaining[dev].append(est - act)
+
+	if not devs:
+		raise ValueError("no estimated work left to simulate")
+
+	daysleft = numpy.empty((trials_n, len(devs)))
+	for i, dev in enumerate(devs):
+		velocities = numpy.array(dev_to_velocities[dev], dtype=float)
+		remaining = numpy.array(dev_to_remaining[dev])
+
+		# Same sampling as random.choice(): seq[int(random() * len(seq))]
+		r = dev_randomstate(seed, dev, batch_i).random_sample(
+		    (trials_n, len(remaining)))
+		idx = (r * len(velocities)).astype(int)
+		hrsleft = (remaining / velocities[idx]).sum(axis=1)
+		daysleft[:, i] = hrsleft / dev_to_dailyworkhours[dev]
+
+	dev_to_daysleftlist = {}
+	for i, dev in enumerate(devs):
+		dev_to_daysleftlist[dev] = daysleft[:, i].tolist()
+
+	return daysleft.max(axis=1).tolist(), dev_to_daysleftlist
+
+def labordays_distribution(remaining, velocities, dailyhours,
+    resolution=0.01, fft_n=2048):
+	'''
+	The exact distribution of one dev's labor days left.
+
+	remaining holds the hours left (est - act) on each of the dev's
+	tickets.  Like the Monte Carlo engines, each ticket takes the
+	hours left divided by a velocity drawn from the dev's history,
+	every velocity being equally likely, independent of the other
+	tickets.  So the labor days left are a sum of independent terms,
+	and the distribution of a sum is the convolution of the terms'
+	distributions.
+
+	We round every term to the closest multiple of resolution labor
+	days and return p, where p[i] is the probability that the dev
+	needs i * resolution labor days.  (An array with NumPy, a list
+	without.)
+
+		>>> p = labordays_distribution( (1.0, 2.0), (1.0, 2.0), 1.0, 0.5)
+		>>> [(i * 0.5, x) for i, x in enumerate(p) if x]
+		[(1.5, 0.25), (2.0, 0.25), (2.5, 0.25), (3.0, 0.25)]
+
+	With NumPy, once the result has more than fft_n points we
+	convolve with FFTs instead of one ticket at a time.
+	'''
+
+	kernels = []
+	for hrsleft in remaining:
+		count = tally([int(0.5 + hrsleft / v / dailyhours / resolution)
+		    for v in velocities])
+		kernels.append(dict([(i, n / float(len(velocities)))
+		    for i, n in count.items()]))
+
+	if numpy is None:
+		p = {0: 1.0}
+		for kernel in kernels:
+			q = {}
+			for i, x in p.items():
+				for j, y in kernel.items():
+					try:
+						q[i + j] += x * y
+					except KeyError:
+						q[i + j] = x * y
+			p = q
+		a = [0.0] * (max(p) + 1)
+		for i, x in p.items():
+			a[i] = x
+		return a
+
+	dense = []
+	for kernel in kernels:
+		k = numpy.zeros(max(kernel) + 1)
+		k[kernel.keys()] = kernel.values()
+		dense.append(k)
+	n = sum([len(k) - 1 for k in dense]) + 1
+
+	if n <= fft_n:
+		p = numpy.ones(1)
+		for k in dense:
+			p = numpy.convolve(p, k)
+		return p
+
+	# Round up to a power of two, which is what FFTs like best.
+	size = 1
+	while size < n:
+		size *= 2
+	f = numpy.ones(size / 2 + 1, dtype=complex)
+	for k in dense:
+		f *= numpy.fft.rfft(k, size)
+	p = numpy.fft.irfft(f, size)[:n]
+
+	# Round-off leaves tiny (even negative) values where there
+	# should be none; they would stretch the min and max.
+	p[p < 1e-12] = 0.0
+	return p / p.sum()
+
+def distribution_percentiles(values, probs, ps):
+	'''
+	For each p in ps, the smallest of the sorted values at which the
+	cumulative probability reaches p.
+
+		>>> distribution_percentiles( (1, 2, 3), (0.25, 0.35, 0.4),
+		...     (0.25, 0.50, 0.75) )
+		(1.5, 2, 3)
+
+	If it reaches p exactly, we take the value half-way to the next
+	one, the same as percentile() does for a whole-number position.
+	'''
+
+	cum = []
+	total = 0.0
+	for prob in probs:
+		total += prob
+		cum.append(total)
+
+	q = []
+	for p in ps:
+		i = bisect_right(cum, p - 1e-9)
+		if i >= len(values):
+			q.append(values[-1])
+		elif abs(cum[i] - p) < 1e-9 and i + 1 < len(values):
+			q.append((values[i] + values[i + 1]) / 2.)
+		else:
+			q.append(values[i])
+	return tuple(q)
+
+def exact_forecast(dev_to_velocities, todo, dev_to_dailyworkhours,
+    calendar, resolution=0.01, tail=0.005):
+	'''
+	Compute the (pdf, devs) of history_to_forecast() without sampling.
+
+	Each dev's labor days left come from labordays_distribution(),
+	and their capacity turns those into a distribution over finish
+	days.  Devs are independent, so the probability that the
+	milestone ships by a given day (the last of them finishes by
+	then) is the product of each dev's probability of finishing by
+	then.
+
+	The true min and max are usually so unlikely that no run of
+	trials would ever see them.  So we drop up to tail (half a
+	percent, the precision of the pdf's percentages) from each end,
+	of both the pdf and each dev's min and max.
+	'''
+
+	dev_to_remaining = {}
+	for dev, ticket, est, act, left in todo:
+		if est < 0.00001:
+			continue
+		# Same KeyError as the Monte Carlo engines.
+		dev_to_velocities[dev]
+		if est - act < 0.0:
+			continue
+		if not dev_to_remaining.has_key(dev):
+			dev_to_remaining[dev] = []
+		dev_to_remaining[dev].append(est - act)
+
+	if not dev_to_remaining:
+		raise ValueError("no estimated work left to simulate")
+
+	startdt = date.today()
+	dev_to_stats = {}
+	dev_to_finish = {}
+	ordinals = set()
+	for dev, remaining in dev_to_remaining.items():
+		p = labordays_distribution(remaining, dev_to_velocities[dev],
+		    dev_to_dailyworkhours[dev], resolution)
+		idx = [i for i, x in enumerate(p) if x > 0.0]
+		labordays = [i * resolution for i in idx]
+		probs = [p[i] for i in idx]
+
+		dev_to_stats[dev] = distribution_percentiles(labordays, probs,
+		    (tail, 0.25, 0.50, 0.75, 1.0 - tail))
+
+		capacity = calendar.capacity(dev, startdt,
+		    dev_to_dailyworkhours[dev])
+		start = capacity.start.toordinal()
+		finish = {}
+		for n, prob in zip(capacity.finish_days(labordays), probs):
+			try:
+				finish[start + n] += prob
+			except KeyError:
+				finish[start + n] = prob
+		days = sorted(finish)
+		cum = []
+		total = 0.0
+		for n in days:
+			total += finish[n]
+			cum.append(total)
+		dev_to_finish[dev] = (days, cum)
+		ordinals.update(days)
+
+	pdf = []
+	last = 0.0
+	for n in sorted(ordinals):
+		shipped = 1.0
+		for days, cum in dev_to_finish.values():
+			i = bisect_right(days, n)
+			if i == 0:
+				shipped = 0.0
+				break
+			shipped *= cum[i - 1]
+		if shipped >= tail and shipped - last > 1e-9:
+			pdf.append( (date.fromordinal(n),
+			    int(0.5 + shipped * 100.0)) )
+		last = shipped
+		if shipped >= 1.0 - tail:
+			break
+
+	devs = devquartiles_from_stats(dev_to_stats, calendar,
+	    dev_to_dailyworkhours)
+	return tuple(pdf), devs
+
+def labordays_from_cache(simulate, cache, dev_to_velocities, todo,
+    dev_to_dailyworkhours, trials_n, seed, batch_i):
+	'''
+	Run simulate() (one of the engines above) for just the devs whose
+	trials we don't already have, and return the dev_to_daysleftlist
+	for everybody.
+
+	cache maps (dev, batch_i) to a (key, daysleft) tuple, where key
+	is everything that dev's draws in that batch depend on: the
+	seed, the number of trials, their velocities, their work hours
+	and the hours left on each of their tickets.  Each dev has their
+	own random stream (see stream_seed()), so a dev whose key hasn't
+	changed would draw exactly the same labor days again, and we
+	reuse them.  When one ticket changes, only its owner is re-run.
+	The labor days are kept as an array of doubles (a NumPy array if
+	we have NumPy), not a list of Python floats, which is several
+	times the size.
+
+		>>> history = (('mark', 1, 1.0, 1.0, 1.0), ('paul', 2, 1.0, 1.0, 0.5))
+		>>> todo = [('mark', 3, 2.0, 0.0, 2.0), ('paul', 4, 2.0, 0.0, 2.0)]
+		>>> v = history_to_dict(history)
+		>>> hrs = {'mark': 1.0, 'paul': 1.0}
+		>>> cache = {}
+		>>> a = labordays_from_cache(labordays_from_loop, cache, v, todo,
+		...     hrs, 3, 42, 0)
+		>>> sorted(a.items())
+		[('mark', [2.0, 2.0, 2.0]), ('paul', [4.0, 4.0, 4.0])]
+		>>> todo[1] = ('paul', 4, 3.0, 0.0, 3.0)
+		>>> mark = cache['mark', 0]
+		>>> b = labordays_from_cache(labordays_from_loop, cache, v, todo,
+		...     hrs, 3, 42, 0)
+		>>> b['paul'], cache['mark', 0] is mark
+		([6.0, 6.0, 6.0], True)
+		>>> b['mark']
+		[2.0, 2.0, 2.0]
+
+	Without a seed the draws can't be repeated, so there is nothing
+	to reuse; we just run simulate().
+	'''
+
+	if seed is None:
+		return simulate(dev_to_velocities, todo, dev_to_dailyworkhours,
+		    trials_n, seed, batch_i)[1]
+
+	#
+	# Only tickets with an estimate and no more actual hours than
+	# estimated take any draws (see labordays_from_loop()).
+	#
+
+	dev_to_remaining = {}
+	for dev, ticket, est, act, left in todo:
+		if not dev_to_remaining.has_key(dev):
+			dev_to_remaining[dev] = []
+		if est < 0.00001:
+			continue
+		# Same KeyError as the engines.
+		dev_to_velocities[dev]
+		if est - act < 0.0:
+			continue
+		dev_to_remaining[dev].append(est - act)
+
+	dev_to_daysleftlist = {}
+	dev_to_key = {}
+	stale = []
+	for dev, remaining in dev_to_remaining.items():
+		if not remaining:
+			continue
+		key = (seed, trials_n, tuple(remaining),
+		    tuple(dev_to_velocities[dev]), dev_to_dailyworkhours[dev])
+		hit = cache.get((dev, batch_i))
+		if hit and hit[0] == key:
+			dev_to_daysleftlist[dev] = hit[1].tolist()
+		else:
+			stale.append(dev)
+			dev_to_key[dev] = key
+
+	if stale:
+		junk, fresh = simulate(dev_to_velocities,
+		    [x for x in todo if x[0] in stale], dev_to_dailyworkhours,
+		    trials_n, seed, batch_i)
+		for dev in stale:
+			if numpy is None:
+				daysleft = array('d', fresh[dev])
+			else:
+				daysleft = numpy.array(fresh[dev], dtype=float)
+			cache[dev, batch_i] = (dev_to_key[dev], daysleft)
+			dev_to_daysleftlist[dev] = fresh[dev]
+
+	return dev_to_daysleftlist
+
+def shipdate_percentiles(pdf, ps=(0.05, 0.50, 0.95)):
+	'''
+	The ship date percentiles we report for a PDF.
+
+		>>> from datetime import date
+		>>> pdf = ((date(2010, 9, 6), 40), (date(2010, 9, 7), 90),
+		...     (date(2010, 9, 8), 100))
+		>>> shipdate_percentiles(pdf)
+		(datetime.date(2010, 9, 6), datetime.date(2010, 9, 7), datetime.date(2010, 9, 8))
+	'''
+
+	mindt = pdf[0][0]
+	days = [(dt - mindt).days for dt, density in pdf]
+	return tuple([mindt + timedelta(x) for x in percentiles(days, ps, True)])
+
+def history_to_forecast(history, todo, dev_to_dailyworkhours, engine=None,
+    calendar=None, batch_n=100, max_trials_n=10000, stable_n=3,
+    seconds=None, seed=None, sketch_size=None, resolution=0.01,
+    cache=None):
+	'''
+	History is a list of 
+
+		(dev, ticket, estimated_hours, actual_hours, velocity)
+
+	tuples.
+
+	Todo is a list of (dev, ticket, est_hrs, act_hrs, todo_hrs)
+	tuples.
+
+	Timecards is a list of (dev, date, total_hours) tuples.  One
+	entry for each unique dev/date combination.
+
+	Given this data, we run a Monte Carlo simulation.  Each round
+	generates one ship date.  We take all the ship dates, and
+	generate two sets of coordinates:
+
+		1. a probability density function for ship date, and
+
+		2. box and whisker plots for each developer's ship date.
+
+	We use the timecard data to get an estimate of how many hours
+	each developer is available per week.  Holidays and vacations
+	come from the calendar.
+
+	The engine is either 'numpy', which runs all trials at once, or
+	'python', which runs them one at a time.  The default is 'numpy'
+	if it is installed; we fall back to 'python' if it is not.
+
+	The 'exact' engine doesn't sample at all; it works out the
+	distribution with exact_forecast(), to within resolution labor
+	days per ticket.  It runs no trials, so it returns trials_n = 0
+	and a status of 'exact', and ignores the batch and seed
+	arguments.
+
+	Labor days are turned into dates with the calendar, a
+	WorkdayCalendar that knows about holidays and each dev's
+	absences.  The default has weekends off and nothing else.
+
+	Trials run in batches of batch_n.  We stop when the first of
+	these happens:
+
+		1. the 5'th, 50'th and 95'th percentile ship dates have
+		   not changed for stable_n batches in a row,
+
+		2. we have run max_trials_n trials, or
+
+		3. more than the given number of seconds have gone by.
+
+	Pass a seed to get the same answer every time for the same
+	inputs.  Each dev gets a separate random stream in each batch
+	(see stream_seed()).
+
+	Ship dates are counted into a histogram of days as each batch
+	comes in, so we never hold more than one batch of them.  By
+	default we do keep every trial's labor days for each dev, to get
+	exact quartiles.  Give a sketch_size to summarize them in a
+	QuantileSketch of that size instead; memory then stays the same
+	however many trials we run, at the cost of approximate quartiles.
+
+	Pass the same cache dictionary (and seed) from one call to the
+	next to keep each dev's trials in it, and only re-run the devs
+	whose tickets, velocities or work hours changed in between.  The
+	answer is the same as a run from scratch.  See
+	labordays_from_cache().
+
+	Return (pdf, devs, trials_n, status), where status is one of
+	'converged', 'max trials', 'time budget' or 'exact'.
+
+	See ebs.txt for the unit tests.
+	'''
+
+	if calendar is None:
+		calendar = WorkdayCalendar()
+	if engine is None:
+		engine = 'numpy'
+	if engine == 'numpy' and numpy is None:
+		engine = 'python'
+	if engine == 'numpy':
+		simulate = labordays_from_matrix
+	elif engine == 'python':
+		simulate = labordays_from_loop
+	elif engine != 'exact':
+		raise ValueError("unknown engine '%s'" % (engine,))
+
+	dev_to_velocities = history_to_dict(history)
+
+	if engine == 'exact':
+		pdf, devs = exact_forecast(dev_to_velocities, todo,
+		    dev_to_dailyworkhours, calendar, resolution)
+		return pdf, devs, 0, 'exact'
+
+	t0 = time()
+	startdt = date.today()
+	dev_to_capacity = {}
+	dev_to_daysleftlist = {}
+	shipdate_count = {}
+	used = {}
+	done_n = 0
+	last_q = None
+	stable_i = 0
+	status = None
+	batch_i = 0
+	while status is None:
+		trials_n = min(batch_n, max_trials_n - done_n)
+		if cache is None:
+			labordays_till_done, dev_to_batch = simulate(
+			    dev_to_velocities, todo, dev_to_dailyworkhours,
+			    trials_n, seed, batch_i)
+		else:
+			dev_to_batch = labordays_from_cache(simulate, cache,
+			    dev_to_velocities, todo, dev_to_dailyworkhours,
+			    trials_n, seed, batch_i)
+			for dev in dev_to_batch:
+				used[dev, batch_i] = True
+		batch_i += 1
 
 		#
 		# Convert labor days to calendar days.  This is ship date.
@@ -445,14 +1421,158 @@ def history_to_plotdata(history, todo, dev_to_dailyworkhours):
 		# then we convert to calendar.
 		#
 
-		shipdate = advance_n_workdays(startdt, labordays_till_done)
-		shipdates.append(shipdate)
+		for dev, daysleft in dev_to_batch.items():
+			if not dev_to_capacity.has_key(dev):
+				dev_to_capacity[dev] = calendar.capacity(dev,
+				    startdt, dev_to_dailyworkhours[dev])
+				if sketch_size:
+					dev_to_daysleftlist[dev] = \
+					    QuantileSketch(sketch_size)
+				else:
+					dev_to_daysleftlist[dev] = []
+			if sketch_size:
+				dev_to_daysleftlist[dev].add(daysleft)
+			else:
+				dev_to_daysleftlist[dev].extend(daysleft)
+		tally(shipdates_from_labordays(dev_to_capacity, dev_to_batch,
+		    trials_n), shipdate_count)
+		done_n += trials_n
+
+		pdf = counts_to_pdf(shipdate_count)
+
+		q = shipdate_percentiles(pdf)
+		if q == last_q:
+			stable_i += 1
+		else:
+			stable_i = 0
+		last_q = q
+
+		if stable_i >= stable_n:
+			status = 'converged'
+		elif done_n >= max_trials_n:
+			status = 'max trials'
+		elif seconds is not None and time() - t0 >= seconds:
+			status = 'time budget'
+
+	# Drop trials for devs and batches this run didn't need.
+	if cache is not None:
+		for k in cache.keys():
+			if not used.has_key(k):
+				del cache[k]
+
+	devs = devquartiles_from_labordays(dev_to_daysleftlist,
+	    done_n, calendar, dev_to_dailyworkhours)
+
+	return pdf, devs, done_n, status
+
+def history_to_plotdata(history, todo, dev_to_dailyworkhours, engine=None,
+    calendar=None, trials_n=1000, seed=None, sketch_size=None):
+	'''
+	Run a fixed number of trials (1,000 by default) and return the
+	(pdf, devs) tuple from history_to_forecast().
+	'''
 
-	pdf = list_to_pdf(shipdates)
+	pdf, devs, trials_n, status = history_to_forecast(history, todo,
+	    dev_to_dailyworkhours, engine, calendar,
+	    batch_n = trials_n, max_trials_n = trials_n, seed = seed,
+	    sketch_size = sketch_size)
+	return pdf, devs
 
-	devs = devquartiles_from_labordays(dev_to_daysleftlist, trials_n)
+#
+# Data every milestone shares, set once per worker process by
+# _init_worker() so we don't pickle it again for every job.
+#
 
-	return pdf, devs
+_shared = None
+
+def _init_worker(shared):
+	global _shared
+	_shared = shared
+
+	# Forked workers inherit the parent's random state; without a
+	# fresh seed they would all draw the same numbers.
+	random.seed()
+	if numpy is not None:
+		numpy.random.seed()
+
+def _forecast_job(job):
+	return forecast_job(_shared, job)
+
+def forecast_job(shared, job):
+	'''
+	Forecast one (milestone, todo) job, given the data shared by all
+	of them, and return a (milestone, forecast, error) tuple.
+	'''
+
+	milestone, todo = job
+	history, dev_to_dailyworkhours, calendar, kwargs = shared
+	try:
+		return milestone, history_to_forecast(history, todo,
+		    dev_to_dailyworkhours, calendar = calendar, **kwargs), None
+	except Exception, e:
+		return milestone, None, "%s: %s" % (e.__class__.__name__, e)
+
+def forecast_milestones(history, milestone_to_todo, dev_to_dailyworkhours,
+    calendar=None, workers=None, **kwargs):
+	'''
+	Run history_to_forecast() for many milestones, spread across a
+	pool of worker processes.
+
+	The history, work hours and calendar are the same for every
+	milestone; only the todo list changes.  Any other keyword
+	arguments are passed through to history_to_forecast().
+
+	workers is the number of processes (default: one per CPU).  With
+	one worker, or one milestone, we don't bother with a pool.
+
+	Return a (forecasts, errors) tuple of dictionaries.  forecasts
+	maps a milestone to its (pdf, devs, trials_n, status) tuple, and
+	errors maps a milestone whose forecast failed to the reason.
+
+		>>> history = (('mark', 1, 1.0, 1.0, 1.0),)
+		>>> todo = {
+		... 'a': (('mark', 2, 2.0, 1.0, 1.0),),
+		... 'b': (('paul', 3, 2.0, 1.0, 1.0),),
+		... }
+		>>> forecasts, errors = forecast_milestones(history, todo,
+		...     {'mark': 1.0, 'paul': 1.0}, workers = 2)
+		>>> forecasts.keys(), errors
+		(['a'], {'b': "KeyError: 'paul'"})
+
+	With one worker, the jobs run in this process, one at a time.
+
+		>>> forecasts, errors = forecast_milestones(history, todo,
+		...     {'mark': 1.0, 'paul': 1.0}, workers = 1)
+		>>> forecasts.keys(), errors
+		(['a'], {'b': "KeyError: 'paul'"})
+	'''
+
+	shared = (history, dev_to_dailyworkhours, calendar, kwargs)
+	jobs = sorted(milestone_to_todo.items())
+
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	workers = min(workers, len(jobs))
+
+	if workers <= 1:
+		results = [forecast_job(shared, job) for job in jobs]
+	else:
+		pool = multiprocessing.Pool(workers, _init_worker, (shared,))
+		try:
+			results = pool.map(_forecast_job, jobs, 1)
+			pool.close()
+		finally:
+			pool.terminate()
+			pool.join()
+
+	forecasts = {}
+	errors = {}
+	for milestone, forecast, err in results:
+		if err is None:
+			forecasts[milestone] = forecast
+		else:
+			errors[milestone] = err
+	return forecasts, errors
 
 if __name__ == '__main__':
 	import doctest
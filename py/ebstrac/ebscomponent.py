@@ -15,30 +15,107 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 # 
 
+import os
 import re
+from time import time
 
 from trac.core import *
+from trac.config import Option, IntOption, FloatOption, BoolOption
+from trac.env import IEnvironmentSetupParticipant
+from trac.ticket.api import ITicketChangeListener
 from trac.web.main import IRequestHandler
 
 import ebstrac
+import ebstrac.cache
+import ebstrac.schema
+
+# trac-admin commands need Trac 0.12 or later.
+try:
+	from trac.admin import IAdminCommandProvider
+	import ebstrac.admin
+except ImportError:
+	IAdminCommandProvider = None
 
 class EBSComponent(Component):
-	implements(IRequestHandler)
+	implements(IRequestHandler, IEnvironmentSetupParticipant,
+	    ITicketChangeListener)
+	if IAdminCommandProvider:
+		implements(IAdminCommandProvider)
+
+	engine = Option('ebs', 'engine', 'numpy',
+	    """Engine used for ship dates: `numpy` runs all Monte Carlo
+	    trials at once, `python` runs them one at a time.  Falls
+	    back to `python` if NumPy is not installed.  `exact` works
+	    out the distribution by convolution instead of sampling.""")
+
+	trials_batch = IntOption('ebs', 'trials_batch', 100,
+	    """Ship date trials run in batches of this size.""")
+
+	trials_stable = IntOption('ebs', 'trials_stable', 3,
+	    """Stop running ship date trials once the 5'th, 50'th and
+	    95'th percentiles have not changed for this many batches.""")
+
+	trials_max = IntOption('ebs', 'trials_max', 10000,
+	    """Never run more than this many ship date trials.""")
+
+	time_budget = FloatOption('ebs', 'time_budget', 10.0,
+	    """Stop running ship date trials after this many seconds,
+	    converged or not.""")
+
+	sketch_size = IntOption('ebs', 'sketch_size', 0,
+	    """Summarize each developer's ship date trials in a sketch
+	    of this many points instead of keeping every trial.  Keeps
+	    memory flat for large `trials_max`, but the developer
+	    quartiles become approximate.  0 keeps every trial.""")
+
+	incremental = BoolOption('ebs', 'incremental', 'true',
+	    """Keep each milestone's ship date trials in memory between
+	    reports, and only re-run the trials of developers whose
+	    tickets changed.  Each process keeps its own, for up to
+	    `cache_size` milestones.""")
+
+	workers = IntOption('ebs', 'workers', 0,
+	    """Number of processes used to forecast many milestones at
+	    once (`/ebs/<user>/shipdates` and `trac-admin ebs forecast`).
+	    0 means one per CPU.""")
+
+	cache_size = IntOption('ebs', 'cache_size', 50,
+	    """Number of ship date reports to keep, so that asking again
+	    before anything has changed doesn't re-run the forecast.
+	    Reports are only kept for the day they were made.  Also the
+	    number of milestones whose trials are kept for `incremental`.
+	    0 turns both off.""")
+
+	cache_dir = Option('ebs', 'cache_dir', '',
+	    """Directory (relative to the environment) to keep the ship
+	    date reports in as well, so that all the processes serving
+	    the environment can use them.  Empty means keep them in
+	    memory only.""")
 
 	def __init__(self):
 		'''register handlers'''
 		h = ebstrac.handlers
+		cache_dir = None
+		if self.cache_dir:
+			cache_dir = os.path.join(self.env.path, self.cache_dir)
+		self.report_cache = ebstrac.cache.ReportCache(self.cache_size,
+		    cache_dir)
+		self.forecast_cache = ebstrac.cache.ReportCache(self.cache_size)
 		self.handlers = (
 		    (h.is_tickets, h.get_tickets),
 		    (h.is_fulltickets, h.get_fulltickets),
 		    (h.is_log, h.get_log),
 		    (h.is_hours, h.post_hours),
+		    (h.is_bulk_hours, h.post_bulk_hours),
 		    (h.is_minutes, h.post_minutes),
 		    (h.is_estimate, h.post_estimate),
+		    (h.is_bulk_estimate, h.post_bulk_estimate),
 		    (h.is_status, h.post_status),
+		    (h.is_bulk_status, h.post_bulk_status),
 		    (h.is_history, h.get_history),
 		    (h.is_clock, h.post_clock),
 		    (h.is_shipdate, h.get_shipdate),
+		    (h.is_shipdates, h.get_shipdates),
 		)
 	
 	def match_request(self, req):
@@ -59,3 +136,83 @@ class EBSComponent(Component):
 		# handler.
 
 		ebstrac.handlers.error(req, "invalid url")
+
+	# IEnvironmentSetupParticipant
+
+	def environment_created(self):
+		db = self.env.get_db_cnx()
+		ebstrac.schema.upgrade(self.env, db)
+		db.commit()
+
+	def environment_needs_upgrade(self, db):
+		return ebstrac.schema.needs_upgrade(self.env, db)
+
+	def upgrade_environment(self, db):
+		ebstrac.schema.upgrade(self.env, db)
+
+	# ITicketChangeListener
+	#
+	# Keep ebs_velocity and the ebs_comment counters in step with
+	# tickets changed through Trac.  (The handlers update them
+	# themselves, as they write the ticket tables directly.)
+
+	def ticket_created(self, ticket):
+		pass
+
+	def ticket_changed(self, ticket, comment, author, old_values):
+		self._ticket_changed(ticket.id)
+
+	def ticket_deleted(self, ticket):
+		self._ticket_changed(ticket.id)
+
+	def _ticket_changed(self, tid):
+		db = self.env.get_db_cnx()
+		cursor = db.cursor()
+		ebstrac.handlers.update_velocity(cursor, tid, int(time()))
+		ebstrac.handlers.sync_comments(cursor, tid)
+		db.commit()
+
+	# IAdminCommandProvider
+
+	def get_admin_commands(self):
+		a = ebstrac.admin
+		commands = (
+		    ('ebs holiday list', '',
+			'List company holidays', a.holiday_list),
+		    ('ebs holiday add', '<YYYY-MM-DD> [name]',
+			'Add a company holiday', a.holiday_add),
+		    ('ebs holiday remove', '<YYYY-MM-DD>',
+			'Remove a company holiday', a.holiday_remove),
+		    ('ebs absence list', '[user]',
+			'List absences, for everyone or for one user',
+			a.absence_list),
+		    ('ebs absence add', '<user> <from> [to] [hours]',
+			'Book a user off work from one date to another '
+			'(inclusive).  Give hours for a partial day off; '
+			'otherwise the whole day is off.', a.absence_add),
+		    ('ebs absence remove', '<user> <from> [to]',
+			'Remove the absences booked for a user between two '
+			'dates (inclusive)', a.absence_remove),
+		    ('ebs timecard backfill', '',
+			'Rebuild the timecards used for hours per work day '
+			'from all the hours ever posted.  The upgrade does '
+			'this once; run it again if ticket_change was edited '
+			'by hand.', a.timecard_backfill),
+		    ('ebs velocity rebuild', '',
+			'Rebuild the velocity history from the closed '
+			'tickets.  The upgrade does this once; run it again '
+			'if the ticket tables were edited by hand.',
+			a.velocity_rebuild),
+		    ('ebs index check', '',
+			'List the database indexes the plugin needs that are '
+			'missing.  "trac-admin <env> upgrade" creates them.',
+			a.index_check),
+		    ('ebs forecast', '[milestone] [...] [seed=N]',
+			'Forecast ship dates for the given milestones, or for '
+			'every milestone that is not completed', a.forecast),
+		)
+		for command, args, help, fcn in commands:
+			yield (command, args, help, None, self._admin_command(fcn))
+
+	def _admin_command(self, fcn):
+		return lambda *args: fcn(self, *args)
@@ -18,10 +18,15 @@
 # XXX: refactor into handlers subdirectory with one module per resource.
 # XXX: Audit that malicious input is handled properly.
 
-from time import time, localtime, strftime, mktime, strptime
+from time import time, strftime, mktime, strptime, sleep
 from datetime import date, timedelta, datetime
+from hashlib import md5
+import csv
+import json
+import random
 import re
 import urllib
+import zlib
 
 # Hack so unit tests run if Trac not installed.
 testing = False
@@ -40,6 +45,9 @@ import ascii_plotter as plotter
 
 magicname='EvidenceBasedSchedulingTimeClockPage'
 
+# How many times post_clock() goes round when racing other requests.
+clock_tries = 5
+
 def string_to_float(s):
 	'''
 	In ticket_change, the value can be None, empty string, multiple
@@ -72,6 +80,19 @@ def string_to_float(s):
 		error(req, 
 		    "can't cast '%s' to float: %s" % (s, ve))
 
+def string_to_date(s):
+	'''
+	Parse a 'YYYY-MM-DD' string.
+
+		>>> string_to_date('2010-09-09')
+		datetime.date(2010, 9, 9)
+
+	Raises ValueError if the string is not a valid date.
+	'''
+
+	year, month, day = map(int, s.strip().split('-'))
+	return date(year, month, day)
+
 def error(req, data):
 	if data[-1] != '\n':
 		data += '\n'
@@ -109,6 +130,113 @@ def pathinfouser_must_equal_remoteuser(req, user):
 	if u1 != user:
 		error(req, "User name mismatch ('%s' != '%s')." % (u1, user))
 
+def get_db(com, req):
+	'''
+	The database connection for this request.  Every lookup and update
+	made while handling a request goes through the one connection, so
+	one handler can call another inside the same transaction.  (Admin
+	commands pass no request, and get a new connection.)
+	'''
+
+	if req is None:
+		return com.env.get_db_cnx()
+	db = getattr(req, 'ebs_db', None)
+	if db is None:
+		db = com.env.get_db_cnx()
+		req.ebs_db = db
+	return db
+
+def begin_snapshot(com, db):
+	'''
+	Start a read-only transaction, so that all the lookups for a report
+	see the database as it was at one moment, even if hours are posted
+	part way through.  End it with end_snapshot().
+	'''
+
+	db.rollback()
+	cursor = db.cursor()
+	scheme = com.env.config.get('trac', 'database').split(':')[0]
+	if scheme == 'postgres':
+		cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+	elif scheme == 'mysql':
+		cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+	else:
+		# pysqlite only starts transactions for updates.
+		cursor.execute("BEGIN")
+
+def end_snapshot(com, db):
+	db.rollback()
+
+def check_modified(com, req, validator):
+	'''
+	Conditional GET.  The validator is anything, cheap to look up,
+	that changes whenever the response would.  If the client already
+	has the response (it sent its ETag in If-None-Match), send a 304
+	and be done.  Otherwise send the ETag header and return, so the
+	handler can go on and make the response.
+
+	The ETag only depends on the request and the validator, so every
+	process serving the environment gives the same one.  There is no
+	Last-Modified, as we have no modification time we can trust (Trac
+	and we store ticket change times in different units).
+
+		>>> class T:
+		...     def __init__(self, **headers): self.headers = headers
+		...     def get_header(self, name): return self.headers.get(name)
+		...     def send_response(self, code): print code
+		...     def send_header(self, name, value): self.headers[name] = value
+		...     def end_headers(self): pass
+		>>> t = T()
+		>>> t.path_info, t.args = '/ebs/mark/tickets', {}
+		>>> check_modified(None, t, (12, 1284000000))
+		>>> etag = t.headers['ETag']
+
+	Ask again with the ETag we were given, and it's a 304.
+
+		>>> t.headers = {'If-None-Match': etag}
+		>>> check_modified(None, t, (12, 1284000000))
+		Traceback (most recent call last):
+		...
+		RequestDone
+
+	Once something changes, it isn't.
+
+		>>> t.headers = {'If-None-Match': etag}
+		>>> check_modified(None, t, (13, 1284000001))
+		>>> t.headers['ETag'] != etag
+		True
+	'''
+
+	# Compressed or not, the response is a different one.
+	resource = (req.path_info, sorted((req.args or {}).items()),
+	    accept_encoding(req))
+	etag = '"%s"' % md5(repr((resource, validator))).hexdigest()
+
+	inm = req.get_header('If-None-Match')
+	match = False
+	if inm:
+		tags = [x.strip() for x in inm.split(',')]
+		match = etag in tags or '*' in tags
+
+	req.send_header('ETag', etag)
+	if match:
+		req.send_response(304)
+		req.end_headers()
+		raise RequestDone
+
+def lookup_owner_fingerprint(db, owner):
+	'''
+	A few cheap numbers that change whenever one of owner's tickets
+	does: through Trac (its changetime), or through us (each change
+	takes a comment number).  So do the number of tickets they own.
+	'''
+
+	cursor = db.cursor()
+	cursor.execute("SELECT count(*), max(t.changetime), sum(c.cnum) "
+	    "FROM ticket t LEFT JOIN ebs_comment c ON c.ticket = t.id "
+	    "WHERE t.owner = %s", (owner,))
+	return tuple(cursor.fetchone())
+
 def is_tickets(req):
 	'''
 		/ebs/mark/tickets 
@@ -126,7 +254,8 @@ def get_tickets(com, req):
 	a = req.path_info.strip('/').split('/')
 	user = a[1]
 
-	db = com.env.get_db_cnx()
+	db = get_db(com, req)
+	check_modified(com, req, lookup_owner_fingerprint(db, user))
 	cursor = db.cursor()
 	sql = "SELECT t.id, t.summary FROM ticket t, enum e " \
 	    + "WHERE t.owner = %s AND e.name = t.priority " \
@@ -141,20 +270,45 @@ def get_tickets(com, req):
 		a.append("%6d  %s" % (tid, tnm))
 	a.append("\n")
 	data = "\n".join(a)
-	req.send_response(200)
-	req.send_header('Content-Type', 'plain/text')
-	req.send_header('Content-Length', len(data))
-	req.write(data)
-	req.write('\n')
-	raise RequestDone
+	send_data(req, data + '\n')
 
 def is_fulltickets(req):
 	'''
 		/ebs/mark/fulltickets 
 		/ebs/mark/fulltickets/
+		/ebs/mark/fulltickets?fields=id,estimate,actual
 	'''
 	a = req.path_info.strip('/').split('/')
-	return  len(a) == 3 and a[2] == 'fulltickets'
+	return  len(a) == 3 and a[2].split('?')[0] == 'fulltickets'
+
+# What fulltickets prints for each ticket, in order.
+fulltickets_fields = ('id', 'summary', 'estimate', 'actual', 'status',
+    'description')
+
+def extract_fields(req):
+	'''
+	The fields query argument, as a tuple in fulltickets_fields order.
+	All fields if there isn't one.
+
+		>>> class T: pass
+		>>> t = T()
+		>>> t.args = {}
+		>>> t.path_info = '/ebs/mark/fulltickets?fields=actual,id'
+		>>> extract_fields(t)
+		('id', 'actual')
+	'''
+
+	s = extract_args(req).get('fields')
+	if s is None and req.args:
+		s = req.args.get('fields')
+	if s is None:
+		return fulltickets_fields
+	fields = s.split(',')
+	for field in fields:
+		if field not in fulltickets_fields:
+			error(req, "unknown field '%s', expected one of: %s" \
+			    % (field, ', '.join(fulltickets_fields)))
+	return tuple([x for x in fulltickets_fields if x in fields])
 
 def get_fulltickets(com, req):
 	'''Lookup all open (status != closed) tickets for a user.'''
@@ -164,52 +318,60 @@ def get_fulltickets(com, req):
 	
 	a = req.path_info.strip('/').split('/')
 	user = a[1]
+	fields = extract_fields(req)
 
-	db = com.env.get_db_cnx()
+	db = get_db(com, req)
+	check_modified(com, req, lookup_owner_fingerprint(db, user))
 	cursor = db.cursor()
 
-	sql = "SELECT id, summary, status, description " \
-	    + "FROM ticket " \
-	    + "WHERE owner = %s AND status != 'closed' " \
-	    + "ORDER BY id"
-	cursor.execute(sql, (user,))
+	#
+	# Pivot the estimate and actual hours out of ticket_custom in the
+	# same query.  Descriptions can be long, so only fetch them if
+	# they were asked for.
+	#
 
-	# XXX: not sure if I can reuse a cursor I am scanning.  (I suspect not.)
-	c1 = db.cursor()
-	sqlact = "SELECT value FROM ticket_custom " \
-	    + "WHERE name = 'actualhours' AND ticket = %s"
-	sqlest = "SELECT value FROM ticket_custom " \
-	    + "WHERE name = 'estimatedhours' AND ticket = %s"
+	desc = "NULL"
+	if 'description' in fields:
+		desc = "t.description"
+	sql = "SELECT t.id, t.summary, t.status, " + desc + ", " \
+	    + "MAX(CASE WHEN c.name = 'estimatedhours' " \
+	    + "THEN c.value END), " \
+	    + "MAX(CASE WHEN c.name = 'actualhours' " \
+	    + "THEN c.value END) " \
+	    + "FROM ticket t " \
+	    + "LEFT JOIN ticket_custom c ON c.ticket = t.id " \
+	    + "AND c.name IN ('estimatedhours', 'actualhours') " \
+	    + "WHERE t.owner = %s AND t.status != 'closed' " \
+	    + "GROUP BY t.id, t.summary, t.status"
+	if 'description' in fields:
+		sql += ", t.description"
+	sql += " ORDER BY t.id"
+	cursor.execute(sql, (user,))
 
+	line = "-----------------------------------------------------------------\n"
 	a = []
-	for (id, summary, status, desc) in cursor.fetchall():
-		c1.execute(sqlact, (id,))
-		act = 0
-		row = c1.fetchone()
-		if row: 
-			act = row[0]
-		c1.execute(sqlest, (id,))
-		est = 0
-		row = c1.fetchone()
-		if row: 
-			est = row[0]
-		fmt = "-----------------------------------------------------------------\n" \
-		    + "id      : %s\n" \
-		    + "summary : %s\n" \
-		    + "estimate: %s\n" \
-		    + "actual  : %s\n" \
-		    + "status  : %s\n" \
-		    + "-----------------------------------------------------------------\n" \
-		    + "%s\n"
-		a.append(fmt % (id, summary, est, act, status, desc))
+	for (id, summary, status, desc, est, act) in cursor.fetchall():
+		if est is None:
+			est = 0
+		if act is None:
+			act = 0
+		values = {
+		    'id': id,
+		    'summary': summary,
+		    'estimate': est,
+		    'actual': act,
+		    'status': status,
+		}
+		s = line
+		for field in fields:
+			if field != 'description':
+				s += "%-8s: %s\n" % (field, values[field])
+		if 'description' in fields:
+			s += line + "%s\n" % (desc,)
+		a.append(s)
 	a.append("\n")
-	data = "\n".join(a)
-	req.send_response(200)
-	req.send_header('Content-Type', 'plain/text')
-	req.send_header('Content-Length', len(data))
-	req.write(data)
-	req.write('\n')
-	raise RequestDone
+	data = "\n".join(a).encode('utf-8') + '\n'
+	send_data(req, data)
 
 def is_log(req):
 	'''
@@ -219,37 +381,56 @@ def is_log(req):
 	a = req.path_info.strip('/').split('/')
 	return len(a) == 3 and a[2] == 'log'
 
-def lookup_timecards(req, db):
+def scan_timecards(db):
 	'''
-	Look through ticket_change table and pull hours worked
-	by day by user.
-
-	Total hours worked by each user on each day, and return a list of
-	(user, day, hours) tuples.
+	Work out timecards the slow way, from the hours changes recorded
+	in ticket_change.  Return a dictionary that maps (user, day,
+	ticket) to the hours worked, with day a 'YYYY-MM-DD' string.
+
+	Since ebs_timecard came along, add_hours_to_ticket() keeps the
+	timecards as it goes (see lookup_timecards()); this is for the
+	hours posted before that.  Like the timecards, it ignores hours
+	taken back off a ticket.
 	'''
 
 	cursor = db.cursor()
-	cursor1 = db.cursor()
+
+	#
+	# Hours that are booked to a different date have the actual date
+	# stored in the comment posted with them: same ticket, author and
+	# time.  Join the comment in, rather than look it up for every
+	# row.  (ticket_change is keyed on ticket, time and field, so
+	# there is at most one.)
+	#
 
 	sql =					\
 	    "SELECT "				\
-	        "author, "			\
-	        "ticket, "			\
-		"time, "			\
-		"oldvalue, "			\
-		"newvalue "			\
+	        "h.author, "			\
+	        "h.ticket, "			\
+		"h.time, "			\
+		"h.oldvalue, "			\
+		"h.newvalue, "			\
+		"c.newvalue "			\
 	    "FROM "				\
-		"ticket_change "		\
+		"ticket_change h "		\
+	    "LEFT JOIN "			\
+		"ticket_change c "		\
+	    "ON "				\
+		"c.ticket = h.ticket AND "	\
+		"c.time = h.time AND "		\
+		"c.author = h.author AND "	\
+		"c.field = 'comment' AND "	\
+		"c.newvalue LIKE 'posted on %' "	\
 	    "WHERE " 				\
-	        "field = 'actualhours' "	\
+	        "h.field = 'actualhours' "	\
 	    "ORDER BY "				\
-		"time"
+		"h.time"
 	cursor.execute(sql)
 
 	d = {}
 	for row in cursor.fetchall():
 		# Split here, not in for in case fetchall() returns nothing.
-		user, tid, epoch_seconds, oldvalue, newvalue = row
+		user, tid, epoch_seconds, oldvalue, newvalue, comment = row
 
 		v0 = string_to_float(oldvalue)
 		v1 = string_to_float(newvalue)
@@ -258,46 +439,204 @@ def lookup_timecards(req, db):
 		if hours < 0.000001:
 			continue
 
-		# Hours that are booked to a different date have the
-		# actual date stored in the related comment field.
-
-		sql = 					\
-		    "SELECT "				\
-			"newvalue "			\
-		    "FROM "				\
-			"ticket_change " 		\
-		    "WHERE "				\
-			"author = %s AND "		\
-		        "field = 'comment' AND "	\
-		        "time = %s AND "		\
-		        "newvalue LIKE 'posted on %'"
-		cursor1.execute(sql, (user, epoch_seconds))
-		row = cursor1.fetchone()
-		if row:
+		if comment:
 			# 'posted on 1285010611, applied to 2010-09-09'
-			a1 = row[0].split()
-			s = a1[-1]
-			year, month, day = map(int, s.split('-'))
-			dt = date(year, month, day)
+			a1 = comment.split()
+			dt = string_to_date(a1[-1])
 		else:
 			dt = date.fromtimestamp(epoch_seconds)
 
+		key = (user, dt.strftime("%Y-%m-%d"), tid)
 		try:
-			d[user, dt] += hours
+			d[key] += hours
 		except KeyError:
-			d[user, dt] = hours
+			d[key] = hours
 
-	if not d:
-		return ()
+	return d
+
+def add_timecard(cursor, user, day, tid, hours):
+	'''
+	Add hours to a user's timecard for the day ('YYYY-MM-DD') and
+	ticket.  Does not commit; this goes in the same transaction as
+	the hours themselves.
+
+	Hours taken back off a ticket don't come off the timecard: they
+	are corrections, not time someone wasn't at work.
+	'''
+
+	if hours < 0.000001:
+		return
+
+	cursor.execute("SELECT hours FROM ebs_timecard "
+	    "WHERE username = %s AND day = %s AND ticket = %s",
+	    (user, day, tid))
+	row = cursor.fetchone()
+	if row:
+		cursor.execute("UPDATE ebs_timecard SET hours = %s "
+		    "WHERE username = %s AND day = %s AND ticket = %s",
+		    (row[0] + hours, user, day, tid))
+	else:
+		cursor.execute("INSERT INTO ebs_timecard "
+		    "(username, day, ticket, hours) VALUES (%s, %s, %s, %s)",
+		    (user, day, tid, hours))
+
+def lookup_timecards(req, db):
+	'''
+	Total hours worked by each user on each day, and return a list of
+	(user, day, hours) tuples, from the ebs_timecard table.
+	'''
 
+	cursor = db.cursor()
+	cursor.execute("SELECT username, day, SUM(hours) FROM ebs_timecard "
+	    "GROUP BY username, day ORDER BY lower(username), day")
 	a = []
-	for (user, dt), hours in d.items():
-		a.append( (user, dt, hours) )
+	for user, day, hours in cursor.fetchall():
+		a.append( (user, string_to_date(day), hours) )
+	return a
 
-	return sorted(a, 
-	    key = lambda x: x[0].lower() + x[1].strftime("%Y%m%d")
-	    )
 
+def sql_day_from_epoch(com, column):
+	'''
+	SQL for the local 'YYYY-MM-DD' date of an epoch seconds column.
+	There is no portable way to say this, so it depends on the
+	database Trac is using.
+
+	The SQL goes into queries with parameters, so it mustn't have a
+	'%' in it: how many times that gets escaped (by us, by Trac, by
+	the database module) depends on the Trac version.  So for MySQL
+	we cast the DATE() to a string, rather than use DATE_FORMAT().
+
+		>>> class T: pass
+		>>> com = T()
+		>>> com.env = T()
+		>>> com.env.config = T()
+		>>> com.env.config.get = lambda section, name: 'mysql://trac@db/trac'
+		>>> sql_day_from_epoch(com, 'h.time')
+		'CAST(DATE(FROM_UNIXTIME(h.time)) AS CHAR)'
+	'''
+
+	scheme = com.env.config.get('trac', 'database').split(':')[0]
+	if scheme == 'postgres':
+		return "to_char(to_timestamp(%s), 'YYYY-MM-DD')" % column
+	if scheme == 'mysql':
+		return "CAST(DATE(FROM_UNIXTIME(%s)) AS CHAR)" % column
+	return "date(%s, 'unixepoch', 'localtime')" % column
+
+# Responses shorter than this (in bytes) aren't worth compressing.
+compress_min = 1024
+
+def accept_encoding(req):
+	'''
+	The compression to use for a response: 'gzip' or 'deflate' if the
+	client's Accept-Encoding takes it (we prefer gzip), or None.
+
+		>>> class T:
+		...     def __init__(self, s): self.s = s
+		...     def get_header(self, name): return self.s
+		>>> accept_encoding(T('gzip, deflate'))
+		'gzip'
+		>>> accept_encoding(T('deflate, gzip;q=0'))
+		'deflate'
+		>>> accept_encoding(T('*'))
+		'gzip'
+		>>> accept_encoding(T('identity')) is None
+		True
+		>>> accept_encoding(T(None)) is None
+		True
+	'''
+
+	s = req.get_header('Accept-Encoding')
+	if not s:
+		return None
+	q = {}
+	for part in s.split(','):
+		a = part.split(';')
+		weight = 1.0
+		for param in a[1:]:
+			name, value = (param.split('=', 1) + [''])[:2]
+			if name.strip() == 'q':
+				try:
+					weight = float(value)
+				except ValueError:
+					weight = 0.0
+		q[a[0].strip().lower()] = weight
+	for coding in ('gzip', 'deflate'):
+		if q.get(coding, q.get('*', 0)) > 0:
+			return coding
+	return None
+
+def compressor(coding):
+	'''
+	A zlib compressobj for coding, 'gzip' or 'deflate'.  (HTTP's
+	deflate is the zlib format, header and all.)
+
+		>>> import zlib
+		>>> z = compressor('gzip')
+		>>> s = z.compress('hello ' * 100) + z.flush()
+		>>> s[:2] == '\x1f\x8b'
+		True
+		>>> zlib.decompress(s, 16 + zlib.MAX_WBITS) == 'hello ' * 100
+		True
+	'''
+
+	wbits = zlib.MAX_WBITS
+	if coding == 'gzip':
+		wbits += 16
+	return zlib.compressobj(6, zlib.DEFLATED, wbits)
+
+def send_data(req, data, content_type='plain/text'):
+	'''
+	Send data as the whole of a 200 response, compressed if it is big
+	enough and the client takes it, and be done.
+	'''
+
+	if isinstance(data, unicode):
+		data = data.encode('utf-8')
+	coding = None
+	if len(data) >= compress_min:
+		coding = accept_encoding(req)
+	if coding:
+		z = compressor(coding)
+		data = z.compress(data) + z.flush()
+	req.send_response(200)
+	req.send_header('Content-Type', content_type)
+	req.send_header('Vary', 'Accept-Encoding')
+	if coding:
+		req.send_header('Content-Encoding', coding)
+	req.send_header('Content-Length', len(data))
+	req.write(data)
+	raise RequestDone
+
+def start_stream(req, content_type='plain/text'):
+	'''
+	Send the headers for a response we write a piece at a time, and
+	return the functions to write a piece with, and to finish with.
+
+	Trac 0.11 and later won't req.write() without a Content-Length,
+	which we don't know until we are done; so once the headers are
+	out, we write straight to the server.  If the client takes it,
+	the pieces are compressed on the way.
+	'''
+
+	coding = accept_encoding(req)
+	req.send_response(200)
+	req.send_header('Content-Type', content_type)
+	req.send_header('Vary', 'Accept-Encoding')
+	if coding:
+		req.send_header('Content-Encoding', coding)
+	req.end_headers()
+	out = getattr(req, '_write', None) or req.write
+	if not coding:
+		return out, lambda: None
+
+	z = compressor(coding)
+	def write(data):
+		data = z.compress(data)
+		if data:
+			out(data)
+	def finish():
+		out(z.flush())
+	return write, finish
 
 def get_log(com, req):
 	'''Lookup all hours logged by user against all tickets.'''
@@ -308,78 +647,81 @@ def get_log(com, req):
 	a = req.path_info.strip('/').split('/')
 	user = a[1]
 
-	db = com.env.get_db_cnx()
+	db = get_db(com, req)
 	cursor = db.cursor()
-	cursor1 = db.cursor()
 
-	sql = "SELECT ticket, time, oldvalue, newvalue " \
-	    + "FROM ticket_change " \
-	    + "WHERE author = %s " \
-	    + "AND field = 'actualhours' " \
-	    + "ORDER BY time"
-	cursor.execute(sql, (user,))
+	# The log only changes when the user posts hours.
+	cursor.execute("SELECT count(*), max(time) FROM ticket_change "
+	    "WHERE author = %s AND field = 'actualhours'", (user,))
+	check_modified(com, req, tuple(cursor.fetchone()))
 
-	a = []
-	sum = 0
-	for row in cursor.fetchall():
-		(tid, epoch_seconds, oldvalue, newvalue) = row
+	#
+	# Hours that are booked to a different date have the actual date
+	# stored in the comment posted with them (see scan_timecards()).
+	# The comment ends in the date, 'posted on 1285010611, applied to
+	# 2010-09-09', so the database can work out the day each row
+	# counts for, and sort on it.
+	#
 
-		v0 = string_to_float(oldvalue)
-		v1 = string_to_float(newvalue)
-		hours = v1 - v0
+	day = "COALESCE(substr(c.newvalue, length(c.newvalue) - 9), %s)" \
+	    % sql_day_from_epoch(com, "h.time")
+	sql = "SELECT h.ticket, h.oldvalue, h.newvalue, " + day + " " \
+	    + "FROM ticket_change h " \
+	    + "LEFT JOIN ticket_change c " \
+	    + "ON c.ticket = h.ticket " \
+	    + "AND c.time = h.time " \
+	    + "AND c.author = h.author " \
+	    + "AND c.field = 'comment' " \
+	    + "AND c.newvalue LIKE 'posted on %' " \
+	    + "WHERE h.author = %s " \
+	    + "AND h.field = 'actualhours' " \
+	    + "ORDER BY " + day + ", h.time"
+	cursor.execute(sql, (user,))
 
-		# Hours that are booked to a different date have the actual
-		# date stored in the related comment field.
-
-		sql = "SELECT newvalue FROM ticket_change " \
-		    + "WHERE author = %s " \
-		    + "AND field = 'comment' " \
-		    + "AND time = %s " \
-		    + "AND newvalue LIKE 'posted on %'"
-		cursor1.execute(sql, (user, epoch_seconds))
-		row = cursor1.fetchone()
-		if row:
-			# 'posted on 1285010611, applied to 2010-09-09'
-			a1 = row[0].split()
-			dt = a1[-1]
-		else:
-			tm = localtime(epoch_seconds)
-			dt ="%04d-%02d-%02d" % (tm[0], tm[1], tm[2])
-		#a.append("%d\t%s\t%.3f" % (tid, dt, hours))
-		a.append((tid, dt, hours))
-		sum += hours
-
-	# sort by dt			
-	a = sorted(a, key=lambda x: x[1])
-	a = ["%d\t%s\t%.3f" % (tid, dt, hours) for tid, dt, hours in a]
-	a.append("total = %.3f" % (sum,))
-	a.append("\n")
-	data = "\n".join(a)
-	req.send_response(200)
-	req.send_header('Content-Type', 'plain/text')
-	req.send_header('Content-Length', len(data))
-	req.write(data)
-	req.write('\n')
+	# Send each batch of rows as we get it; there may be years' worth.
+	write, finish = start_stream(req)
+	sum = 0
+	while True:
+		rows = cursor.fetchmany(500)
+		if not rows:
+			break
+		a = []
+		for tid, oldvalue, newvalue, dt in rows:
+			v0 = string_to_float(oldvalue)
+			v1 = string_to_float(newvalue)
+			hours = v1 - v0
+			a.append("%d\t%s\t%.3f\n" % (tid, dt, hours))
+			sum += hours
+		write("".join(a).encode('utf-8'))
+	write("total = %.3f\n\n\n" % (sum,))
+	finish()
 	raise RequestDone
 
-def lookup_todo(req, db, milestone):
+def lookup_todos(db, milestones):
 	'''
-	Return a list of 
+	Return a (milestone_to_todo, milestone_to_bad) tuple for the given
+	milestones, where milestone_to_todo maps each milestone that has
+	open tickets to a list of
 
 		(user, ticket, estimated_hours, actual_hours, left)
 
-	tuples for all tickets that are open for the given milestone.
+	tuples, and milestone_to_bad maps a milestone to the ids of its
+	open tickets that have actual hours but no estimate.
 
 	We include tickets with a zero estimate.
 	'''
 
+	if not milestones:
+		return {}, {}
+
 	cursor = db.cursor()
 
 	sql = '''SELECT 
 		t.id,
 		t.owner,
 		e.hours as estimate,
-		a.hours as actual
+		a.hours as actual,
+		t.milestone
 	FROM
 		ticket t, 
 		(
@@ -410,13 +752,13 @@ def lookup_todo(req, db, milestone):
 		t.id = e.ticket AND
 		e.ticket = a.ticket AND
 		t.status <> 'closed' AND
-		t.milestone = %s
+		t.milestone IN (%s)
 	ORDER BY
 		t.owner,
 		t.id
-	'''
+	''' % ", ".join(["%s"] * len(milestones))
 
-	cursor.execute(sql, (milestone,))
+	cursor.execute(sql, tuple(milestones))
 
 	#
 	# NOTE: 
@@ -436,8 +778,9 @@ def lookup_todo(req, db, milestone):
 	rows = sorted(cursor.fetchall(), 
 	    key = lambda x: x[1].lower() + "%015d" % x[0])
 
-	a = []
-	for (tid, owner, est, act) in rows:
+	d = {}
+	bad = {}
+	for (tid, owner, est, act, milestone) in rows:
 		
 		#
 		# If a ticket has actual hours, it is supposed to have an
@@ -448,34 +791,88 @@ def lookup_todo(req, db, milestone):
 
 		thresh = 0.000001
 		if est < thresh and act > thresh:
-			efmt = "Ticket %d has actual hours but a "  \
-			    "zero estimate---fix data and re-run."
-			error(req, efmt % tid)
+			if not bad.has_key(milestone):
+				bad[milestone] = []
+			bad[milestone].append(tid)
 
 		# XXX: remove calculated value (est - act) from tuple.
 		todo = est - act
-		a.append((owner, tid, est, act, todo))
+		if not d.has_key(milestone):
+			d[milestone] = []
+		d[milestone].append((owner, tid, est, act, todo))
 
-	return tuple(a)
+	for milestone, a in d.items():
+		d[milestone] = tuple(a)
 
+	return d, bad
 
-def lookup_history(db):
+def lookup_todo(req, db, milestone):
 	'''
 	Return a list of 
 
-		(user, ticket, estimated_hours, actual_hours, velocity)
+		(user, ticket, estimated_hours, actual_hours, left)
 
-	tuples for all tickets closed as "fixed" that had time booked
-	to them.
+	tuples for all tickets that are open for the given milestone.
+
+	Returns an error page if a ticket has actual hours but no
+	estimate.
 	'''
 
+	d, bad = lookup_todos(db, (milestone,))
+	if bad.has_key(milestone):
+		efmt = "Ticket %d has actual hours but a "  \
+		    "zero estimate---fix data and re-run."
+		error(req, efmt % bad[milestone][0])
+
+	return d.get(milestone, ())
+
+def lookup_active_milestones(db):
+	'''Names of the milestones that are not completed.'''
+
 	cursor = db.cursor()
+	sql = "SELECT name FROM milestone " \
+	    + "WHERE completed IS NULL OR completed = 0 " \
+	    + "ORDER BY name"
+	cursor.execute(sql)
+	return [row[0] for row in cursor.fetchall()]
+
+
+def scan_history(cursor, tid=None):
+	'''
+	Work out the velocity history the slow way, from the ticket and
+	ticket_custom tables.  Return a list of
+
+		(user, ticket, estimated_hours, actual_hours, velocity,
+		    closed_at)
+
+	tuples for all tickets closed as "fixed" that had time booked to
+	them, or just for ticket tid.  closed_at is when the ticket was
+	last closed, in seconds, or None if ticket_change doesn't say.
+	(Trac 0.12 and later time their changes in microseconds, so those
+	are scaled down before we take the latest; see seconds_max.)
+
+	lookup_history() reads the ebs_velocity table that is built from
+	this (see update_velocity()).
+	'''
 
 	sql = '''SELECT 
 		t.id,
 		t.owner,
 		e.hours as estimate,
-		a.hours as actual
+		a.hours as actual,
+		(
+			SELECT
+				max(CASE
+				    WHEN c.time >= %s THEN c.time / 1000000
+				    ELSE c.time
+				END)
+			FROM
+				ticket_change c
+			WHERE
+				c.ticket = t.id AND
+				c.field = 'status' AND
+				c.newvalue = 'closed'
+		) as closed_at
 	FROM
 		ticket t, 
 		(
@@ -507,12 +904,13 @@ def lookup_history(db):
 		e.ticket = a.ticket AND
 		t.status = 'closed' AND
 		t.resolution = 'fixed'
-	ORDER BY
-		t.owner,
-		t.id
 	'''
+	params = [seconds_max]
+	if tid is not None:
+		sql += " AND t.id = %s"
+		params.append(tid)
 
-	cursor.execute(sql)
+	cursor.execute(sql, params)
 
 	#
 	# NOTE: 
@@ -533,7 +931,7 @@ def lookup_history(db):
 	    key = lambda x: x[1].lower() + "%015d" % x[0])
 
 	a = []
-	for (tid, owner, est, act) in rows:
+	for (tid, owner, est, act, closed_at) in rows:
 		
 		#
 		# Tickets with zero actual hours are not interesting.
@@ -559,8 +957,126 @@ def lookup_history(db):
 		#
 
 		velocity = est / act
-		a.append((owner, tid, est, act, velocity))
+		if closed_at is not None:
+			# MySQL's / gives a decimal
+			closed_at = int(closed_at)
+		a.append((owner, tid, est, act, velocity, closed_at))
+
+	return a
+
+def update_velocity(cursor, tid, tm):
+	'''
+	Bring ticket tid's row in ebs_velocity up to date after it changed
+	at tm (seconds).  Call it whenever a ticket is closed or reopened,
+	or its owner or hours change.  Does not commit.
+
+	A ticket that stays closed keeps the time it was first closed.
+	'''
+
+	tid = int(tid)
+	cursor.execute("SELECT closed_at FROM ebs_velocity WHERE ticket = %s",
+	    (tid,))
+	row = cursor.fetchone()
+	closed_at = tm
+	if row and row[0] is not None:
+		closed_at = row[0]
+
+	cursor.execute("DELETE FROM ebs_velocity WHERE ticket = %s", (tid,))
+	for owner, tid, est, act, velocity, ignore in scan_history(cursor, tid):
+		cursor.execute("INSERT INTO ebs_velocity "
+		    "(owner, ticket, est, act, velocity, closed_at) "
+		    "VALUES (%s, %s, %s, %s, %s, %s)",
+		    (owner, tid, est, act, velocity, closed_at))
+
+def lookup_history(db, owner=None, since=None, until=None):
+	'''
+	Return a list of 
+
+		(user, ticket, estimated_hours, actual_hours, velocity)
+
+	tuples for all tickets closed as "fixed" that had time booked
+	to them.  Narrow it down to one owner, or to the tickets closed
+	from the date since to the date until (inclusive), if given.
+	'''
+
+	sql = "SELECT owner, ticket, est, act, velocity FROM ebs_velocity"
+	where = []
+	params = []
+	if owner is not None:
+		where.append("owner = %s")
+		params.append(owner)
+	if since is not None:
+		where.append("closed_at >= %s")
+		params.append(int(mktime(since.timetuple())))
+	if until is not None:
+		where.append("closed_at < %s")
+		params.append(int(mktime((until + timedelta(1)).timetuple())))
+	if where:
+		sql += " WHERE " + " AND ".join(where)
+	sql += " ORDER BY lower(owner), ticket"
+
+	cursor = db.cursor()
+	cursor.execute(sql, params)
+	return tuple([tuple(row) for row in cursor.fetchall()])
+
+
+def lookup_calendar(db, startdt=None):
+	'''
+	Return a WorkdayCalendar with the company holidays and each dev's
+	absences.
+
+	Only absences on or after startdt (default today) are loaded, as
+	past ones can't change a forecast.
+	'''
+
+	if startdt is None:
+		startdt = date.today()
+
+	cursor = db.cursor()
+
+	cursor.execute("SELECT day FROM ebs_holiday")
+	holidays = [string_to_date(row[0]) for row in cursor.fetchall()]
+
+	sql = "SELECT username, day, hours FROM ebs_absence WHERE day >= %s"
+	cursor.execute(sql, (startdt.strftime("%Y-%m-%d"),))
+	absences = {}
+	for user, day, hours in cursor.fetchall():
+		if not absences.has_key(user):
+			absences[user] = {}
+		absences[user][string_to_date(day)] = hours
+
+	return ebs.WorkdayCalendar(holidays = holidays, absences = absences)
+
+def lookup_fingerprint(db):
+	'''
+	A few cheap numbers that change whenever the data a forecast uses
+	does: hours, estimates or status posted through us (each one
+	takes a comment number), tickets added or changed through Trac,
+	and holidays and absences booked.  Rows edited by hand in the
+	ticket tables can slip past it.
+
+	Holidays and absences are few, and a swap (one holiday for
+	another, say) leaves their count alone, so those are a hash of
+	every row.
+	'''
 
+	cursor = db.cursor()
+	a = []
+	for sql in (
+	    "SELECT max(time) FROM ticket_change",
+	    "SELECT count(*), max(changetime) FROM ticket",
+	    "SELECT count(*), sum(cnum) FROM ebs_comment",
+	    ):
+		cursor.execute(sql)
+		a.extend(cursor.fetchone())
+	for sql in (
+	    "SELECT day FROM ebs_holiday ORDER BY day",
+	    "SELECT username, day, hours FROM ebs_absence "
+		"ORDER BY username, day",
+	    ):
+		cursor.execute(sql)
+		rows = [tuple(row) for row in cursor.fetchall()]
+		a.append(md5(repr(rows)).hexdigest())
 	return tuple(a)
 
 
@@ -568,9 +1084,10 @@ def is_history(req):
 	'''
 		/ebs/mark/history
 		/ebs/mark/history/
+		/ebs/mark/history?owner=paul&since=2010-09-01
 	'''
 	a = req.path_info.strip('/').split('/')
-	return len(a) == 3 and a[2] == 'history'
+	return len(a) == 3 and a[2].split('?')[0] == 'history'
 
 def get_history(com, req):
 	'''Report history of hours and tickets across all users.'''
@@ -581,17 +1098,28 @@ def get_history(com, req):
 	a = req.path_info.strip('/').split('/')
 	user = a[1]
 
-	db = com.env.get_db_cnx()
-	history = lookup_history(db)
+	args = dict(req.args or {})
+	args.update(extract_args(req))
+	owner = args.get('owner')
+	since, until = None, None
+	try:
+		if args.get('since'):
+			since = string_to_date(args['since'])
+		if args.get('until'):
+			until = string_to_date(args['until'])
+	except ValueError:
+		error(req, "%s: invalid date, expected YYYY-MM-DD" % f)
+
+	db = get_db(com, req)
+	cursor = db.cursor()
+	cursor.execute("SELECT count(*), max(closed_at), sum(est), sum(act) "
+	    "FROM ebs_velocity")
+	check_modified(com, req, tuple(cursor.fetchone()))
+	history = lookup_history(db, owner, since, until)
 
 	#for (owner, tid, est, act, velocity) in history:
 	data = "\n".join(["%-10s %6d %5.2f %5.2f %5.2f" % h for h in history])
-	req.send_response(200)
-	req.send_header('Content-Type', 'plain/text')
-	req.send_header('Content-Length', len(data))
-	req.write(data)
-	req.write('\n')
-	raise RequestDone
+	send_data(req, data + '\n')
 
 def is_hours(req):
 	'''
@@ -603,12 +1131,20 @@ def is_hours(req):
 	a = req.path_info.strip('/').split('/')
 	return len(a) in (5, 6) and a[2] == 'ticket' and a[4] == 'hours'
 
-def add_hours_to_ticket(com, req, user, tid, delta, dt=None):
-	'''Associate the hours someone worked with a ticket.'''
+def add_hours_to_ticket(com, req, user, tid, delta, dt=None, db=None):
+	'''
+	Associate the hours someone worked with a ticket.
+
+	If given a db, the hours go in its transaction and it is up to the
+	caller to commit, or to roll back: a database error (a lock, say)
+	is raised for the caller to deal with, rather than returned.
+	'''
 
 	f = "add_hours_to_ticket"
 
-	db = com.env.get_db_cnx()
+	commit = db is None
+	if db is None:
+		db = get_db(com, req)
 	cursor = db.cursor()
 
 	user_must_own_ticket(req, cursor, tid, user)
@@ -645,6 +1181,13 @@ def add_hours_to_ticket(com, req, user, tid, delta, dt=None):
 		error(req, "You can't charge time until you " \
 		    + "have made an estimate.")
 
+	if dt is not None:
+		try:
+			string_to_date(dt)
+		except ValueError:
+			error(req, "%s: invalid date '%s', expected YYYY-MM-DD" \
+			    % (f, dt))
+
 	# if any exceptions, rollback everything
 	ok = True
 	try:
@@ -660,30 +1203,11 @@ def add_hours_to_ticket(com, req, user, tid, delta, dt=None):
 		# table.  However, Trac does enter a comment record, so
 		# I'll mimic that behavior here.  
 		#
+		# A bulk post to the same ticket in the same second takes
+		# times after ours, so ask next_change() for one.
+		#
 
-		sql = "SELECT max(oldvalue) FROM ticket_change " \
-		    + "WHERE ticket = %s AND field = 'comment'"
-		params = (tid, )
-		cursor.execute(sql, params)
-		row = cursor.fetchone()
-		col_n = 0
-		if row and row[0]:
-			
-			#
-			# If you have added a new ticket comment that is a reply
-			# to an existing comment, then Trac stores the oldvalue
-			# as:
-			#
-			#	<replied_to_comment#>.<new_comment_#>
-			#
-			# and casting to an int fails.
-			#
-
-			last_comment_number = row[0].split('.')[-1]
-			col_n = int(last_comment_number)
-		col_n += 1
-
-		tm = int(time())
+		tm, col_n = next_change(cursor, tid, int(time()))
 
 		sql = "INSERT INTO ticket_change ( " \
 		    + "ticket, time, author, field, oldvalue, newvalue" \
@@ -706,8 +1230,19 @@ def add_hours_to_ticket(com, req, user, tid, delta, dt=None):
 			params[-1] = 'posted on %d, applied to %s' % (tm, dt)
 		cursor.execute(sql, params)
 
-		db.commit()
+		day = dt
+		if day is None:
+			day = date.fromtimestamp(tm).strftime("%Y-%m-%d")
+		else:
+			day = string_to_date(day).strftime("%Y-%m-%d")
+		add_timecard(cursor, user, day, int(tid), delta)
+		update_velocity(cursor, tid, tm)
+
+		if commit:
+			db.commit()
 	except Exception, e:
+		if not commit:
+			raise
 		db.rollback()
 		efmt = "%s: %s, sql=%s, params=%s"
 		com.log.error(efmt % (f, e, sql, params))
@@ -755,42 +1290,424 @@ def post_minutes(com, req):
 	hours = hours / 60.
 	add_hours_and_return(com, req, hours)
 
-def is_estimate(req):
+def is_bulk_hours(req):
 	'''
-		/ebs/mark/ticket/1/estimate
-		/ebs/mark/ticket/1/estimate/
+		/ebs/mark/hours
+		/ebs/mark/hours/
 	'''
 	a = req.path_info.strip('/').split('/')
-	return len(a) == 5 and a[2] == 'ticket' and a[4] == 'estimate'
+	return len(a) == 3 and a[2] == 'hours'
 
-def post_estimate(com, req):
-	'''Associate an estimate with a ticket.'''
-	f = "post_estimate"
-	if req.method != 'GET':
-		error(req, "%s: expected a GET" % f)
-
-	a = req.path_info.strip('/').split('/')
-	user = a[1]
-	tid = a[3]
+def parse_rows(data, is_json, columns, optional_n=0):
+	'''
+	Split the body of a bulk post into rows, and return a list of
 
-	db = com.env.get_db_cnx()
-	cursor = db.cursor()
+		(row, ticket, value, ...)
 
-	user_must_own_ticket(req, cursor, tid, user)
+	tuples, with one value for each of columns after the ticket, and
+	a list of error messages.  Rows are numbered from 1.
 
-	pathinfouser_must_equal_remoteuser(req, user)
+	CSV has one row per line, and a first line of column names is
+	skipped.  JSON is a list of objects keyed by column name, or of
+	lists.  The last optional_n columns can be left off; they come
+	back as None.
 
-	sql = "SELECT value FROM ticket_custom " \
-	    + "WHERE name = 'estimatedhours' AND ticket = %s"
-	cursor.execute(sql, (tid,))
-	row = cursor.fetchone()
-	if not row:
-		efmt = "%s: ticket %s doesn't have estimatedhours custom field"
-		error(req, efmt % (f, tid))
+		>>> parse_rows('ticket,status\\n10,closed\\n11\\n', False,
+		...     ('ticket', 'status', 'resolution'), 1)
+		([(1, 10, 'closed', None)], ['row 2: expected ticket, status and resolution'])
+	'''
 
-	oldval = 0.0
-	if row[0]:
-		oldval = string_to_float(row[0])
+	if is_json:
+		try:
+			a = json.loads(data)
+		except ValueError, e:
+			return [], ["invalid JSON: %s" % e]
+		if not isinstance(a, list):
+			return [], ["expected a JSON list of rows"]
+	else:
+		a = [x for x in csv.reader(data.splitlines()) if x]
+		if a and a[0] and a[0][0].strip().lower() == columns[0]:
+			a = a[1:]
+
+	rows = []
+	errors = []
+	for n, x in enumerate(a):
+		n += 1
+		if isinstance(x, dict):
+			x = [x.get(column) for column in columns]
+		if not isinstance(x, (list, tuple)) \
+		    or not len(columns) - optional_n <= len(x) <= len(columns):
+			errors.append("row %d: expected %s and %s" % (n,
+			    ", ".join(columns[:-1]), columns[-1]))
+			continue
+		x = list(x) + [None] * (len(columns) - len(x))
+		try:
+			x[0] = int(x[0])
+		except (TypeError, ValueError):
+			errors.append("row %d: invalid ticket '%s'" % (n, x[0]))
+			continue
+		rows.append(tuple([n] + x))
+
+	return rows, errors
+
+def parse_bulk_hours(data, is_json):
+	'''
+	Parse the body of a bulk hours post into a list of
+
+		(row, ticket, date, hours)
+
+	tuples and a list of error messages (see parse_rows()).  date is
+	a 'YYYY-MM-DD' string, or None for today.
+
+	In CSV, the date can be left empty:
+
+		>>> rows, errors = parse_bulk_hours(
+		...     'ticket,date,hours\\n10,2010-09-09,1.5\\n11,,2\\n', False)
+		>>> rows
+		[(1, 10, '2010-09-09', 1.5), (2, 11, None, 2.0)]
+
+	In JSON, so can the date key:
+
+		>>> rows, errors = parse_bulk_hours(
+		...     '[{"ticket": 10, "date": "2010-09-09", "hours": 1.5}]', True)
+		>>> rows
+		[(1, 10, '2010-09-09', 1.5)]
+
+	Rows that don't parse are left out and reported:
+
+		>>> rows, errors = parse_bulk_hours('10,2010-09-31,1\\nx,,1\\n', False)
+		>>> rows
+		[]
+		>>> for e in errors: print e
+		row 1: invalid date '2010-09-31', expected YYYY-MM-DD
+		row 2: invalid ticket 'x'
+	'''
+
+	rows, errors = parse_rows(data, is_json, ('ticket', 'date', 'hours'))
+	a = []
+	for n, tid, dt, hours in rows:
+		if dt is not None and not isinstance(dt, basestring):
+			dt = str(dt)
+		dt = dt and dt.strip() or None
+		if dt is not None:
+			try:
+				dt = string_to_date(dt).strftime("%Y-%m-%d")
+			except ValueError:
+				errors.append("row %d: invalid date '%s', "
+				    "expected YYYY-MM-DD" % (n, dt))
+				continue
+		try:
+			hours = float(hours)
+		except (TypeError, ValueError):
+			errors.append("row %d: invalid hours '%s'" % (n, hours))
+			continue
+		a.append((n, tid, dt, hours))
+
+	errors.sort(key = row_number)
+	return a, errors
+
+def row_number(msg):
+	'''Sort key for error messages, so they come out in row order.'''
+
+	if msg.startswith('row '):
+		return int(msg.split()[1].rstrip(':'))
+	return 0
+
+def scan_comments(cursor, tid=None):
+	'''
+	Work out the last comment number on each ticket (or just ticket
+	tid) the slow way, from ticket_change.  Return a dictionary that
+	maps ticket to number.
+
+	The number is in oldvalue, which is a string, so max() in SQL
+	would put 9 after 10.  And if you have added a new ticket comment
+	that is a reply to an existing comment, then Trac stores the
+	oldvalue as:
+
+		<replied_to_comment#>.<new_comment_#>
+
+	so we have to take it apart in Python.
+	'''
+
+	sql = "SELECT ticket, oldvalue FROM ticket_change " \
+	    + "WHERE field = 'comment'"
+	params = ()
+	if tid is not None:
+		sql += " AND ticket = %s"
+		params = (int(tid),)
+	cursor.execute(sql, params)
+	d = {}
+	for tid, oldvalue in cursor.fetchall():
+		try:
+			n = int((oldvalue or '0').split('.')[-1])
+		except ValueError:
+			continue
+		if n > d.get(tid, 0):
+			d[tid] = n
+	return d
+
+def reserve_comments(cursor, tid, n=1):
+	'''
+	Reserve n comment numbers on ticket tid, and return the first.
+
+	The last number used on each ticket is kept in ebs_comment.  The
+	counter is bumped in the caller's transaction, which locks it, so
+	two posts to a ticket at once can't get the same number.  A
+	ticket with no counter yet starts from scan_comments().
+	'''
+
+	tid = int(tid)
+	cursor.execute("UPDATE ebs_comment SET cnum = cnum + %s "
+	    "WHERE ticket = %s", (n, tid))
+	cursor.execute("SELECT cnum FROM ebs_comment WHERE ticket = %s",
+	    (tid,))
+	row = cursor.fetchone()
+	if row:
+		return row[0] - n + 1
+	last = scan_comments(cursor, tid).get(tid, 0)
+	cursor.execute("INSERT INTO ebs_comment (ticket, cnum) "
+	    "VALUES (%s, %s)", (tid, last + n))
+	return last + 1
+
+def sync_comments(cursor, tid):
+	'''
+	Catch ticket tid's counter up with comments made through Trac,
+	which doesn't know about it.  Does not commit.
+	'''
+
+	tid = int(tid)
+	last = scan_comments(cursor, tid).get(tid)
+	cursor.execute("DELETE FROM ebs_comment WHERE ticket = %s", (tid,))
+	if last:
+		cursor.execute("INSERT INTO ebs_comment (ticket, cnum) "
+		    "VALUES (%s, %s)", (tid, last))
+
+# ticket_change times at or above this are Trac's, in microseconds
+# (Trac 0.12 and later); ours are in seconds.  It is in the year 5138
+# as seconds, and in 1970 as microseconds.
+seconds_max = 10 ** 11
+
+def next_changes(cursor, tids, tm):
+	'''
+	Return a dictionary that maps each ticket to the (time, comment
+	number) its first change should use, when changing it at tm.
+	tids has a ticket for each change, so a ticket changed three times
+	is in it three times, and gets three comment numbers reserved.
+
+	ticket_change is keyed on ticket, time and field, so a ticket
+	changed more than once in a request needs a new time for each
+	change: count up from tm, or from the ticket's last change if
+	that is later.
+
+	Only our own changes count.  Trac 0.12 and later store times in
+	microseconds, so a change made through Trac can't collide with
+	ours, and counting up from it would give a time in the far
+	future (see seconds_max).
+	'''
+
+	counts = {}
+	for tid in tids:
+		counts[tid] = counts.get(tid, 0) + 1
+	d = {}
+	for tid in counts.keys():
+		d[tid] = (tm, reserve_comments(cursor, tid, counts[tid]))
+	if not d:
+		return d
+	sql = "SELECT ticket, max(time) " \
+	    + "FROM ticket_change WHERE ticket IN (%s) " \
+	    % ", ".join(["%s"] * len(d)) \
+	    + "AND time < %s GROUP BY ticket"
+	cursor.execute(sql, d.keys() + [seconds_max])
+	for tid, last_tm in cursor.fetchall():
+		d[tid] = (max(tm, last_tm + 1), d[tid][1])
+	return d
+
+def next_change(cursor, tid, tm):
+	'''
+	The (time, comment number) for a single change to ticket tid at
+	tm; see next_changes().
+	'''
+
+	tid = int(tid)
+	return next_changes(cursor, [tid], tm)[tid]
+
+def post_bulk_hours(com, req):
+	'''
+	Book many rows of hours at once, from a CSV or JSON body (see
+	parse_bulk_hours()).  Each row is checked the way a single post
+	to ticket/<id>/hours is; if any row fails, none are booked, and
+	the response lists every row that failed.  Otherwise all the
+	rows go in one transaction.
+	'''
+
+	f = "post_bulk_hours"
+	if req.method != 'POST':
+		error(req, "%s: expected a POST" % f)
+
+	a = req.path_info.strip('/').split('/')
+	user = a[1]
+
+	pathinfouser_must_equal_remoteuser(req, user)
+
+	ctype = req.get_header('Content-Type') or ''
+	rows, errors = parse_bulk_hours(req.read(), 'json' in ctype)
+	if not rows and not errors:
+		error(req, "%s: no hours given" % f)
+
+	db = get_db(com, req)
+	cursor = db.cursor()
+
+	#
+	# Check every ticket in one go.  Like add_hours_to_ticket(), the
+	# user must own the ticket, it must have an estimate, and its
+	# hours can't go below zero.
+	#
+
+	tids = sorted(set([tid for n, tid, dt, hours in rows]))
+	tid_to_row = {}
+	if tids:
+		sql = "SELECT t.id, t.owner, a.value, e.value " \
+		    + "FROM ticket t " \
+		    + "LEFT JOIN ticket_custom a " \
+		    + "ON a.ticket = t.id AND a.name = 'actualhours' " \
+		    + "LEFT JOIN ticket_custom e " \
+		    + "ON e.ticket = t.id AND e.name = 'estimatedhours' " \
+		    + "WHERE t.id IN (%s)" % ", ".join(["%s"] * len(tids))
+		params = tids
+		cursor.execute(sql, params)
+		for tid, owner, act, est in cursor.fetchall():
+			tid_to_row[tid] = (owner, act, est)
+
+	tid_to_hours = {}
+	for n, tid, dt, hours in rows:
+		if not tid_to_row.has_key(tid):
+			errors.append("row %d: ticket %s not found." % (n, tid))
+			continue
+		owner, act, est = tid_to_row[tid]
+		if owner != user:
+			errors.append("row %d: ticket %s not owned by %s."
+			    % (n, tid, user))
+			continue
+		if act is None:
+			errors.append("row %d: ticket %s doesn't have "
+			    "actualhours custom field" % (n, tid))
+			continue
+		if not est or string_to_float(est) < 0.01:
+			errors.append("row %d: You can't charge time until you "
+			    "have made an estimate." % n)
+			continue
+		oldval = tid_to_hours.get(tid, string_to_float(act))
+		if oldval + hours < 0:
+			errors.append("row %d: can't end up with negative hours, "
+			    "task only has %s hours" % (n, oldval))
+			continue
+		tid_to_hours[tid] = oldval + hours
+
+	if errors:
+		errors.sort(key = row_number)
+		error(req, "\n".join(errors))
+
+	tm = int(time())
+	ok = True
+	try:
+		tid_to_next = next_changes(cursor, [row[1] for row in rows],
+		    tm)
+		changes = []
+		tid_to_hours = {}
+		for n, tid, dt, hours in rows:
+			tm1, col_n = tid_to_next[tid]
+			tid_to_next[tid] = (tm1 + 1, col_n + 1)
+
+			oldval = tid_to_hours.get(tid,
+			    string_to_float(tid_to_row[tid][1]))
+			newval = oldval + hours
+			tid_to_hours[tid] = newval
+
+			comment = ''
+			day = date.fromtimestamp(tm1).strftime("%Y-%m-%d")
+			if dt is not None:
+				comment = 'posted on %d, applied to %s' % (tm1, dt)
+				day = dt
+			changes.append((tid, tm1, user, 'actualhours', oldval,
+			    newval))
+			changes.append((tid, tm1, user, 'comment', col_n,
+			    comment))
+			add_timecard(cursor, user, day, tid, hours)
+
+		sql = "INSERT INTO ticket_change ( " \
+		    + "ticket, time, author, field, oldvalue, newvalue" \
+		    + ") VALUES ( " \
+		    + "%s, %s, %s, %s, %s, %s" \
+		    + ")"
+		params = changes
+		cursor.executemany(sql, params)
+
+		sql = "UPDATE ticket_custom SET value = %s " \
+		    + "WHERE ticket=%s AND name='actualhours'"
+		params = [(newval, tid) for tid, newval in tid_to_hours.items()]
+		cursor.executemany(sql, params)
+
+		for tid in tids:
+			update_velocity(cursor, tid, tm)
+
+		db.commit()
+	except Exception, e:
+		db.rollback()
+		efmt = "%s: %s, sql=%s, params=%s"
+		com.log.error(efmt % (f, e, sql, params))
+		ok = False
+
+	if not ok:
+		error(req, "Internal error.")
+
+	fmt = "%s: %s logged %.4f hours in %d rows to %d tickets"
+	com.log.info(fmt % (f, user, sum([x[3] for x in rows]), len(rows),
+	    len(tids)))
+
+	data = "OK, %d rows" % len(rows)
+	req.send_response(200)
+	req.send_header('Content-Type', 'plain/text')
+	req.send_header('Content-Length', len(data))
+	req.write(data)
+	req.write('\n')
+	raise RequestDone
+
+def is_estimate(req):
+	'''
+		/ebs/mark/ticket/1/estimate
+		/ebs/mark/ticket/1/estimate/
+	'''
+	a = req.path_info.strip('/').split('/')
+	return len(a) == 5 and a[2] == 'ticket' and a[4] == 'estimate'
+
+def post_estimate(com, req):
+	'''Associate an estimate with a ticket.'''
+	f = "post_estimate"
+	if req.method != 'GET':
+		error(req, "%s: expected a GET" % f)
+
+	a = req.path_info.strip('/').split('/')
+	user = a[1]
+	tid = a[3]
+
+	db = get_db(com, req)
+	cursor = db.cursor()
+
+	user_must_own_ticket(req, cursor, tid, user)
+
+	pathinfouser_must_equal_remoteuser(req, user)
+
+	sql = "SELECT value FROM ticket_custom " \
+	    + "WHERE name = 'estimatedhours' AND ticket = %s"
+	cursor.execute(sql, (tid,))
+	row = cursor.fetchone()
+	if not row:
+		efmt = "%s: ticket %s doesn't have estimatedhours custom field"
+		error(req, efmt % (f, tid))
+
+	oldval = 0.0
+	if row[0]:
+		oldval = string_to_float(row[0])
 	newval = string_to_float(req.args['data'])
 	if newval < 0:
 		efmt = "%s: can't have a negative estimate"
@@ -810,19 +1727,9 @@ def post_estimate(com, req):
 		# While I don't see where the comment text is that Trac
 		# renders, I know it is not stored in the ticket_change
 		# table.  However, Trac does enter a comment record, so
-		# I'll mimic that behavior here.  
-		sql = "SELECT max(oldvalue) FROM ticket_change " \
-		    + "WHERE ticket = %s AND field = 'comment'"
-		params = (tid, )
-		cursor.execute(sql, params)
-		row = cursor.fetchone()
-		col_n = 0
-		if row and row[0]:
-			last_comment_number = row[0].split('.')[-1]
-			col_n = int(last_comment_number)
-		col_n += 1
-
-		dt = int(time())
+		# I'll mimic that behavior here.  (next_change() gives us
+		# a time no other change to the ticket has taken.)
+		dt, col_n = next_change(cursor, tid, int(time()))
 		sql = "INSERT INTO ticket_change ( " \
 		    + "ticket, time, author, field, oldvalue, newvalue" \
 		    + ") VALUES ( " \
@@ -839,6 +1746,8 @@ def post_estimate(com, req):
 		params = (tid, dt, user, 'comment', col_n, '')
 		cursor.execute(sql, params)
 
+		update_velocity(cursor, tid, dt)
+
 		db.commit()
 	except Exception, e:
 		db.rollback()
@@ -858,6 +1767,139 @@ def post_estimate(com, req):
 		error(req, "Internal error.")
 
 
+def is_bulk_estimate(req):
+	'''
+		/ebs/mark/estimate
+		/ebs/mark/estimate/
+	'''
+	a = req.path_info.strip('/').split('/')
+	return len(a) == 3 and a[2] == 'estimate'
+
+def post_bulk_estimate(com, req):
+	'''
+	Set many estimates at once, from CSV ticket,estimate rows or a
+	JSON list of {"ticket", "estimate"} objects.  Like the bulk
+	hours, either every row is good and they all go in one
+	transaction, or nothing changes and every bad row is listed.
+
+	Returns a line per ticket: the ticket, the old estimate and the
+	new one.
+	'''
+
+	f = "post_bulk_estimate"
+	if req.method != 'POST':
+		error(req, "%s: expected a POST" % f)
+
+	a = req.path_info.strip('/').split('/')
+	user = a[1]
+
+	pathinfouser_must_equal_remoteuser(req, user)
+
+	ctype = req.get_header('Content-Type') or ''
+	rows, errors = parse_rows(req.read(), 'json' in ctype,
+	    ('ticket', 'estimate'))
+	a = []
+	for n, tid, newval in rows:
+		try:
+			newval = float(newval)
+		except (TypeError, ValueError):
+			errors.append("row %d: invalid estimate '%s'" % (n, newval))
+			continue
+		if newval < 0:
+			errors.append("row %d: can't have a negative estimate" % n)
+			continue
+		a.append((n, tid, newval))
+	rows = a
+	if not rows and not errors:
+		error(req, "%s: no estimates given" % f)
+
+	db = get_db(com, req)
+	cursor = db.cursor()
+
+	tids = sorted(set([tid for n, tid, newval in rows]))
+	tid_to_row = {}
+	if tids:
+		sql = "SELECT t.id, t.owner, e.value " \
+		    + "FROM ticket t " \
+		    + "LEFT JOIN ticket_custom e " \
+		    + "ON e.ticket = t.id AND e.name = 'estimatedhours' " \
+		    + "WHERE t.id IN (%s)" % ", ".join(["%s"] * len(tids))
+		params = tids
+		cursor.execute(sql, params)
+		for tid, owner, est in cursor.fetchall():
+			tid_to_row[tid] = (owner, est)
+
+	for n, tid, newval in rows:
+		if not tid_to_row.has_key(tid):
+			errors.append("row %d: ticket %s not found." % (n, tid))
+		elif tid_to_row[tid][0] != user:
+			errors.append("row %d: ticket %s not owned by %s."
+			    % (n, tid, user))
+		elif tid_to_row[tid][1] is None:
+			errors.append("row %d: ticket %s doesn't have "
+			    "estimatedhours custom field" % (n, tid))
+
+	if errors:
+		errors.sort(key = row_number)
+		error(req, "\n".join(errors))
+
+	tm = int(time())
+	ok = True
+	try:
+		tid_to_next = next_changes(cursor, [row[1] for row in rows],
+		    tm)
+		changes = []
+		tid_to_est = {}
+		out = []
+		for n, tid, newval in rows:
+			tm1, col_n = tid_to_next[tid]
+			tid_to_next[tid] = (tm1 + 1, col_n + 1)
+
+			oldval = tid_to_est.get(tid,
+			    string_to_float(tid_to_row[tid][1]))
+			tid_to_est[tid] = newval
+			changes.append((tid, tm1, user, 'estimatedhours', oldval,
+			    newval))
+			changes.append((tid, tm1, user, 'comment', col_n, ''))
+			out.append("%d %.2f %.2f" % (tid, oldval, newval))
+
+		sql = "INSERT INTO ticket_change ( " \
+		    + "ticket, time, author, field, oldvalue, newvalue" \
+		    + ") VALUES ( " \
+		    + "%s, %s, %s, %s, %s, %s" \
+		    + ")"
+		params = changes
+		cursor.executemany(sql, params)
+
+		sql = "UPDATE ticket_custom SET value = %s " \
+		    + "WHERE ticket=%s AND name='estimatedhours'"
+		params = [(newval, tid) for tid, newval in tid_to_est.items()]
+		cursor.executemany(sql, params)
+
+		for tid in tids:
+			update_velocity(cursor, tid, tm)
+
+		db.commit()
+	except Exception, e:
+		db.rollback()
+		efmt = "%s: %s, sql=%s, params=%s"
+		com.log.error(efmt % (f, e, sql, params))
+		ok = False
+
+	if not ok:
+		error(req, "Internal error.")
+
+	fmt = "%s: %s set %d estimates on %d tickets"
+	com.log.info(fmt % (f, user, len(rows), len(tids)))
+
+	data = "\n".join(out)
+	req.send_response(200)
+	req.send_header('Content-Type', 'plain/text')
+	req.send_header('Content-Length', len(data))
+	req.write(data)
+	req.write('\n')
+	raise RequestDone
+
 def is_clock(req):
 	'''
 		/ebs/mark/clock
@@ -871,6 +1913,9 @@ def lookup_clocktext(cursor):
 	'''
 	Return None if wiki page does not exist.
 	Return '' if wiki page exists, but is empty.
+
+	The clocks used to be kept in this page; now it is only read to
+	move them into ebs_clock (see scan_wiki_clocks()).
 	'''
 
 	global magicname
@@ -892,250 +1937,131 @@ def lookup_clocktext(cursor):
 		return row[0]
 	else:
 		return None
-	
-def update_clocktext(com, req, db, cursor, user, ip, data):
-	'''
-	We use wiki page to store current state of time clock for all users.
-
-	Format of page is detailed in at least two other places in this 
-	module.
 
-	Create wiki page if it doesn't exist.
-
-	Return True on success, False if exception on insert.
+def scan_wiki_clocks(cursor):
 	'''
+	Read the clocks from the old wiki page, and return a list of
+	(user, ticket, started_at) tuples, started_at in seconds.
 
-	global magicname
-
-	# Trac wiki versioning is one-based, not zero-based.
-	initial_trac_wiki_version = 1
-
-	#
-	#  data = ( (uid1, tid1, dt1, tm1), (uid2, tid2, dt2, tm2), ...)
-	# 
-	# This next step was fragile on initial deployment ("not enough
-	# args for format string"), so do it less Pythonically so we
-	# can put good info in error message for debugging.
-	#
+	Each row of text is a record, with the following space-delimited
+	columns:
+		1. user id
+		2. ticket id
+		3. date
+		4. time
 
- 	#text = "\r".join(["%s %d %s %s" % row for row in data])
+	Trac uses carriage returns to indicate newlines in wiki text.
+	Dates and times are in the server's localtime.
+	'''
 
+	s = lookup_clocktext(cursor) or ''
 	a = []
-	for row in data:
+	for line in s.split('\r'):
+		columns = line.split()
+		if len(columns) != 4:
+			continue
+		user, tid, dt, tm = columns
 		try:
-			a.append("%s %s %s %s" % tuple(row))
-		# TypeError catches both not enough args and type errors,
-		# like trying to print a string with a '%d' format.
-		except TypeError, te:
-			efmt = "update_clocktext failed: %s raised %s"
-			error(req, efmt % (str(row), te))
-	text = "\r".join(a)
-
-        cursor.execute(
-	    "SELECT max(version) FROM wiki WHERE name = %s GROUP BY name",
-	     (magicname,)
-	     )
-	version = initial_trac_wiki_version
-	row = cursor.fetchone()
-	version = row[0]
-
-	ok = True
-	
-	if not version:
-		# First time, insert page record.
-
-		sql = "INSERT INTO wiki ("	\
-			"name, "	\
-			"version, "	\
-			"time, "	\
-			"author, "	\
-			"ipnr, "	\
-			"text, "	\
-			"readonly "	\
-		    ") VALUES ("	\
-			"%s, "	\
-			"%s, "	\
-			"%s, "	\
-			"%s, "	\
-			"%s, "	\
-			"%s, "	\
-			"%s "	\
-		    ")"
-		
-		params = (
-		    magicname,
-		    version,
-		    time(), 
-		    user,
-		    ip, 
-		    text,
-		    1
-		    )
-	else:
-		# To avoid having a zillion revisions for this one wiki
-		# page, we keep re-using version 1.
-		sql = \
-		    "UPDATE wiki SET "	\
-			"text = %s "	\
-		    "WHERE "	\
-			"name = %s AND version = %s"
-		params = (text, magicname, version)
-
-	try:
-		cursor.execute(sql, params)
-		db.commit()
-	except Exception, e:
-		db.rollback()
-		efmt = "%s: %s, sql=%s, params=%s"
-		com.log.error(efmt % (f, e, sql, params))
-		ok = False
-
-	return ok
-
+			t0 = strptime(" ".join((dt, tm)), "%Y-%m-%d %H:%M:%S")
+			a.append((user, int(tid), int(mktime(t0))))
+		except ValueError:
+			continue
+	return a
 
-def elapsed_hours(dt, tm):
+def lookup_clock(cursor, user):
+	'''
+	Return the (ticket, started_at) of user's running clock, or None
+	if it isn't running.
 	'''
-	Compute elapsed time between dt ("YYYY-MM-DD") and tm ("HH:MM:SS")
-	and now. (EDT)
-
-	If no timezone specified, strptime() uses -1 for the tm_isdst 
-	(daylight savings flag), which expresses the time as localtime,
-	not UTC.
-
-		>>> import time
-		>>> s = "2010-09-30 08:02:41"
-		>>> time.strptime(s, "%Y-%m-%d %H:%M:%S")
-		(2010, 9, 30, 8, 2, 41, 3, 273, -1)
-
-	This is what we want, as all clock times are handled in server's
-	localtime.
 
-	We return the difference in hours.
+	cursor.execute("SELECT ticket, started_at FROM ebs_clock "
+	    "WHERE username = %s", (user,))
+	row = cursor.fetchone()
+	if row:
+		return tuple(row)
+	return None
 
-		>>> t0 = localtime(time.time() - 60 * 60)
-		>>> dt = time.strftime("%Y-%m-%d", t0)
-		>>> tm = time.strftime("%H:%M:%S", t0)
-		>>> elapsed_hours(dt, tm)
-		1.0
+def hours_since(started_at):
+	'''
+	Hours from started_at (in seconds) to now.  No rounding.
 
-	Even if only one minute has elapsed.
+		>>> "%.3f" % hours_since(int(time()) - 30 * 60)
+		'0.500'
+	'''
 
-		>>> t0 = localtime(time.time() - 60 * 1)
-		>>> dt = time.strftime("%Y-%m-%d", t0)
-		>>> tm = time.strftime("%H:%M:%S", t0)
-		>>> "%.3f" % elapsed_hours(dt, tm)
-		'0.017'
-		
-	Method does no rounding.  Thirty seconds is 3/360'ths
-	of an hour.
+	return (int(time()) - started_at) / float(60 * 60)
 
-		>>> t0 = localtime(time.time() - 30 * 1)
-		>>> dt = time.strftime("%Y-%m-%d", t0)
-		>>> tm = time.strftime("%H:%M:%S", t0)
-		>>> "%.5f" % elapsed_hours(dt, tm)
-		'0.00833'
+def remove_clock(cursor, user, last):
+	'''
+	Delete user's clock, but only if it is still last, the (ticket,
+	started_at) we read.  Return False if another request changed it
+	in the meantime.  Doesn't commit.
 	'''
 
-	fmt = "%Y-%m-%d %H:%M:%S"
-	s = " ".join((dt, tm))
-	t0 = mktime(strptime(s, fmt))
-	t1 = int(time())
-	return (t1 - t0) / float(60 * 60)
-
+	tid, started_at = last
+	cursor.execute("DELETE FROM ebs_clock "
+	    "WHERE username = %s AND ticket = %s AND started_at = %s",
+	    (user, tid, started_at))
+	return cursor.rowcount == 1
 
-def stop_clock(com, req, user, ticketid, dt, tm):
+def stop_clock(com, req, db, user, ticketid, started_at):
 	'''
-	Compute elapsed time since dt and tm and add hours to ticket
-	for user.
+	Stop user's clock and add the hours since started_at to the
+	ticket.  Doesn't commit, so that the caller can start the next
+	clock in the same transaction.
 
-	Return the hours we logged.
+	Return the hours we logged, or None if another request stopped
+	or changed the clock first.
 	'''
 
-	hours = elapsed_hours(dt, tm)
-	ok = add_hours_to_ticket(com, req, user, ticketid, hours)
+	if not remove_clock(db.cursor(), user, (ticketid, started_at)):
+		return None
+	hours = hours_since(started_at)
+	ok = add_hours_to_ticket(com, req, user, ticketid, hours, db=db)
 	if not ok:
 		error(req, "Internal error.")
 	return hours
 
-def post_clock(com, req):
+def start_clock(cursor, user, tid, started_at):
 	'''
-	We store clock data in a wiki page with the "magic" name
-
-		EvidenceBasedSchedulingTimeClockPage
-
-	Each row of text is a record, with the following space-delimited
-	columns:
-		1. user id
-		2. ticket id
-		3. date
-		4. time
+	Start user's clock on ticket tid, as long as they don't have one
+	running.  Return False if they do (another request started it).
+	Doesn't commit.
 
-	If there is no record for a user, they have no row.  We store the 
-	current state only.
+	MySQL before 8.0 won't take a SELECT with a WHERE and no FROM,
+	hence the one-row table.
 	'''
 
-	global magicname
-	f = "post_clock"
-
-	a = req.path_info.strip('/').split('/')
-	user = a[1]
-	tid = None
-	if len(a) == 4:
-		try:
-			tid = int(a[3])
-		except TypeError:
-			error(req, "%s must be a ticket number" % a[3])
-
-	pathinfouser_must_equal_remoteuser(req, user)
-
-	db = com.env.get_db_cnx()
-	cursor = db.cursor()
-	s = lookup_clocktext(cursor)
-	if s is None:
-		s = ''
+	cursor.execute("INSERT INTO ebs_clock (username, ticket, started_at) "
+	    "SELECT %s, %s, %s FROM (SELECT 1) AS one WHERE NOT EXISTS "
+	    "(SELECT * FROM ebs_clock WHERE username = %s)",
+	    (user, tid, started_at, user))
+	return cursor.rowcount == 1
 
-	# Get clock data from wiki page.  Each row of text is a record,
-	# with the following space-delimited columns:
-	#
-	# 	1. user id
-	# 	2. ticket id
-	# 	3. date
-	# 	4. time
-	#
-	# Trac uses carriage returns to indicate newlines in wiki text.
-	#
+def change_clock(com, req, db, user, tid, verb, last):
+	'''
+	Stop, clear or start user's clock, given the clock they had
+	running (last, as from lookup_clock()).  Doesn't commit.  Returns
+	what to tell the user, or None if the clock was no longer last.
+	'''
 
-	lines = s.split('\r')
-	a = []
-	last = ()
-	for line in lines:
-		if not line.strip():
-			continue
-		columns = line.split(' ')
-		if columns[0] == user:
-			last = columns[1:]
-			# Remove old entry from data array
-			continue
-		a.append(columns)
 	if last:
-		lasttid = int(last[0])
-		lastdt = last[1]
-		lasttm = last[2]
+		lasttid, laststarted = last
 
-	# $ ebscp <verb> clock
 	data = ""
-	verb = req.args['data'].lower()
 	if verb == 'stop':
 		if last:
-			hours_logged = stop_clock(com, req, user, *last)
+			hours_logged = stop_clock(com, req, db, user, *last)
+			if hours_logged is None:
+				return None
 			data = "Logged %.3f hours to ticket %d" % \
 			    (hours_logged, lasttid)
 		else:
 			# nothing running, so nothing to stop.
 			pass
 	elif verb == 'clear':
-		# Leave user out of data array (as it is now)
-		pass
+		if last and not remove_clock(db.cursor(), user, last):
+			return None
 	elif verb == 'start':
 
 		if not tid:
@@ -1150,7 +2076,7 @@ def post_clock(com, req):
 			#
 
 			if tid == lasttid:
-				hours = elapsed_hours(lastdt, lasttm)
+				hours = hours_since(laststarted)
 				msg = "Clock already running for ticket %d, " \
 				    "started %.2f hours ago."
 				data = msg % (tid, hours)
@@ -1169,28 +2095,85 @@ def post_clock(com, req):
 			# the ticket.
 			#
 
-			hours_logged = stop_clock(com, req, user, *last)
+			hours_logged = stop_clock(com, req, db, user, *last)
+			if hours_logged is None:
+				return None
 			data = "Logged %.3f hours to ticket %d" % \
 			    (hours_logged, lasttid)
 
-		epoch_seconds = int(time())
-		a.append( (
-		    user, 
-		    tid, 
-		    strftime("%Y-%m-%d", localtime(epoch_seconds)),
-		    strftime("%H:%M:%S", localtime(epoch_seconds))
-		    ) )
+		if not start_clock(db.cursor(), user, tid, int(time())):
+			return None
 
 		if data:
 			data += ", and started clock for ticket %d." % tid
 		else:
 			data = "Started clock for ticket %d." % tid
 
-	# Update the magic wiki page to the next version.
+	return data
+
+def post_clock(com, req):
+	'''
+	Each user has at most one clock running, kept as a row of the
+	ebs_clock table: the ticket they are working on, and when they
+	started (in seconds).  If there is no row for a user, they have
+	no clock running.
+	'''
+
+	f = "post_clock"
+
+	a = req.path_info.strip('/').split('/')
+	user = a[1]
+	tid = None
+	if len(a) == 4:
+		try:
+			tid = int(a[3])
+		except ValueError:
+			error(req, "%s must be a ticket number" % a[3])
+
+	pathinfouser_must_equal_remoteuser(req, user)
+
+	db = get_db(com, req)
 
-	if not update_clocktext(com, req, db, cursor, user, req.remote_addr, a):
+	# $ ebscp <verb> clock
+	verb = req.args['data'].lower()
+
+	#
+	# Each change is a compare-and-set: a clock is only stopped or
+	# replaced if it is still the one we read, and only started if
+	# there isn't one.  So two requests for the same user at once
+	# can't both log the same hours, or drop each other's clock.  The
+	# one that loses reads the clock again and has another go.  (So
+	# does one that hits a locked database.)
+	#
+	# The hours (if any) and the new clock go in together, or not at
+	# all.
+	#
+
+	data = None
+	for attempt in range(clock_tries):
+		failed = None
+		try:
+			last = lookup_clock(db.cursor(), user)
+			data = change_clock(com, req, db, user, tid, verb, last)
+			if data is not None:
+				db.commit()
+				break
+			db.rollback()
+		except RequestDone:
+			db.rollback()
+			raise
+		except Exception, e:
+			db.rollback()
+			com.log.warning("%s: %s (try %d)" % (f, e, attempt + 1))
+			failed = e
+			data = None
+		sleep(random.random() * 0.05 * (attempt + 1))
+
+	if data is None and failed is not None:
 		error(req, 
 		    "Boom!  (Probably some DB issue, check server logs.)")
+	if data is None:
+		error(req, "Clock kept changing under us, try again.")
 
 	if not data:
 		data="OK"
@@ -1211,6 +2194,32 @@ def is_status(req):
 	a = req.path_info.strip('/').split('/')
 	return len(a) == 5 and a[2] == 'ticket' and a[4] == 'status'
 
+def status_error(oldval, newval):
+	'''
+	Why a ticket can't go from status oldval to newval, or None if it
+	can.
+
+		>>> status_error('new', 'closed')
+		>>> status_error('closed', 'closed')
+		'ticket already closed'
+	'''
+
+	if oldval == 'closed' and newval == 'closed':
+		return 'ticket already closed'
+
+	if oldval in ('new', 'reopened', 'assigned') and newval == 'reopened':
+		return 'ticket already open'
+
+	if oldval == 'closed' and newval != 'reopened':
+		return "ticket is closed, so the only valid new status " \
+		    + "is 'reopened'"
+
+	if oldval in ('new', 'reopened', 'assigned') and newval != 'closed':
+		return "ticket is open, only valid new status is " \
+		    + "'closed'"
+
+	return None
+
 def post_status(com, req):
 	'''Change a ticket's status.'''
 	f = "post_status"
@@ -1221,7 +2230,7 @@ def post_status(com, req):
 	user = a[1]
 	tid = a[3]
 
-	db = com.env.get_db_cnx()
+	db = get_db(com, req)
 	cursor = db.cursor()
 
 	user_must_own_ticket(req, cursor, tid, user)
@@ -1238,24 +2247,14 @@ def post_status(com, req):
 
 	# Sanity checking on status. (SQL will put in whatever we say.)
 
-	if oldval == 'closed' and newval == 'closed':
-		error(req, 'ticket already closed')
-
-	if oldval in ('new', 'reopened', 'assigned') and newval == 'reopened':
-		error(req, 'ticket already open')
-
-	if oldval == 'closed' and newval != 'reopened':
-		error(req, "ticket is closed, so the only valid new status " \
-		    + "is 'reopened'")
-
-	if oldval in ('new', 'reopened', 'assigned') and newval != 'closed':
-		error(req, "ticket is open, only valid new status is " \
-		    + "'closed'")
+	msg = status_error(oldval, newval)
+	if msg:
+		error(req, msg)
 
 	# If any exceptions, rollback everything.
 	ok = True
 	try:
-		tm = int(mktime(localtime()))
+		tm, col_n = next_change(cursor, tid, int(time()))
 
 		resolution = ''
 		if newval == 'closed':
@@ -1288,17 +2287,8 @@ def post_status(com, req):
 		# While I don't see where the comment text is that Trac
 		# renders, I know it is not stored in the ticket_change
 		# table.  However, Trac does enter a comment record, so
-		# I'll mimic that behavior here.  
-
-		sql = "SELECT max(oldvalue) FROM ticket_change " \
-		    + "WHERE ticket = %s AND field = 'comment'"
-		params = (tid, )
-		cursor.execute(sql, params)
-		row = cursor.fetchone()
-		col_n = 0
-		if row and row[0]:
-			col_n = int(row[0])
-		col_n += 1
+		# I'll mimic that behavior here.  (Its number came from
+		# next_change(), above.)
 
 		sql = "INSERT INTO ticket_change ( " \
 		    + "ticket, time, author, field, oldvalue, newvalue" \
@@ -1308,6 +2298,8 @@ def post_status(com, req):
 		params = [tid, tm, user, 'comment', col_n, '']
 		cursor.execute(sql, params)
 
+		update_velocity(cursor, tid, tm)
+
 		db.commit()
 
 	except Exception, e:
@@ -1327,6 +2319,154 @@ def post_status(com, req):
 	else:
 		error(req, "Internal error.")
 
+def is_bulk_status(req):
+	'''
+		/ebs/mark/status
+		/ebs/mark/status/
+	'''
+	a = req.path_info.strip('/').split('/')
+	return len(a) == 3 and a[2] == 'status'
+
+def post_bulk_status(com, req):
+	'''
+	Change the status of many tickets at once, from CSV
+	ticket,status,resolution rows or a JSON list of {"ticket",
+	"status", "resolution"} objects.  The resolution can be left out;
+	it defaults to 'fixed' when closing a ticket.  Like the bulk
+	hours, either every row is good and they all go in one
+	transaction, or nothing changes and every bad row is listed.
+
+	Returns a line per ticket: the ticket, the old status and the new
+	one, and the resolution if it was closed.
+	'''
+
+	f = "post_bulk_status"
+	if req.method != 'POST':
+		error(req, "%s: expected a POST" % f)
+
+	a = req.path_info.strip('/').split('/')
+	user = a[1]
+
+	pathinfouser_must_equal_remoteuser(req, user)
+
+	ctype = req.get_header('Content-Type') or ''
+	rows, errors = parse_rows(req.read(), 'json' in ctype,
+	    ('ticket', 'status', 'resolution'), 1)
+	if not rows and not errors:
+		error(req, "%s: no changes given" % f)
+
+	db = get_db(com, req)
+	cursor = db.cursor()
+
+	cursor.execute("SELECT name FROM enum WHERE type = 'resolution'")
+	resolutions = [row[0] for row in cursor.fetchall()]
+
+	tids = sorted(set([row[1] for row in rows]))
+	tid_to_row = {}
+	if tids:
+		sql = "SELECT id, owner, status, resolution FROM ticket " \
+		    + "WHERE id IN (%s)" % ", ".join(["%s"] * len(tids))
+		params = tids
+		cursor.execute(sql, params)
+		for tid, owner, status, resolution in cursor.fetchall():
+			tid_to_row[tid] = (owner, status, resolution)
+
+	# Check each change against the status the row before it left.
+	a = []
+	tid_to_status = {}
+	for n, tid, newval, resolution in rows:
+		newval = (newval or '').strip()
+		resolution = (resolution or '').strip()
+		if not tid_to_row.has_key(tid):
+			errors.append("row %d: ticket %s not found." % (n, tid))
+			continue
+		owner, oldval, oldresolution = tid_to_row[tid]
+		if owner != user:
+			errors.append("row %d: ticket %s not owned by %s."
+			    % (n, tid, user))
+			continue
+		oldval, oldresolution = tid_to_status.get(tid,
+		    (oldval, oldresolution))
+		msg = status_error(oldval, newval)
+		if msg:
+			errors.append("row %d: ticket %s: %s" % (n, tid, msg))
+			continue
+		if newval == 'closed':
+			resolution = resolution or 'fixed'
+			if resolution not in resolutions:
+				errors.append("row %d: unknown resolution '%s', "
+				    "expected one of: %s"
+				    % (n, resolution, ', '.join(resolutions)))
+				continue
+		elif resolution:
+			errors.append("row %d: only a closed ticket has a "
+			    "resolution" % n)
+			continue
+		tid_to_status[tid] = (newval, resolution)
+		a.append((n, tid, oldval, newval, oldresolution, resolution))
+	rows = a
+
+	if errors:
+		errors.sort(key = row_number)
+		error(req, "\n".join(errors))
+
+	tm = int(time())
+	ok = True
+	try:
+		tid_to_next = next_changes(cursor, [row[1] for row in rows],
+		    tm)
+		changes = []
+		out = []
+		for n, tid, oldval, newval, oldresolution, resolution in rows:
+			tm1, col_n = tid_to_next[tid]
+			tid_to_next[tid] = (tm1 + 1, col_n + 1)
+
+			changes.append((tid, tm1, user, 'status', oldval, newval))
+			changes.append((tid, tm1, user, 'resolution',
+			    oldresolution, resolution))
+			changes.append((tid, tm1, user, 'comment', col_n, ''))
+			out.append(("%d %s %s %s" % (tid, oldval, newval,
+			    resolution)).rstrip())
+
+		sql = "INSERT INTO ticket_change ( " \
+		    + "ticket, time, author, field, oldvalue, newvalue" \
+		    + ") VALUES ( " \
+		    + "%s, %s, %s, %s, %s, %s" \
+		    + ")"
+		params = changes
+		cursor.executemany(sql, params)
+
+		sql = "UPDATE ticket " \
+		    + "SET status = %s, resolution = %s "\
+		    + "WHERE id = %s"
+		params = [(newval, resolution, tid) for tid, (newval,
+		    resolution) in tid_to_status.items()]
+		cursor.executemany(sql, params)
+
+		for tid in tids:
+			update_velocity(cursor, tid, tm)
+
+		db.commit()
+	except Exception, e:
+		db.rollback()
+		efmt = "%s: %s, sql=%s, params=%s"
+		com.log.error(efmt % (f, e, sql, params))
+		ok = False
+
+	if not ok:
+		error(req, "Internal error.")
+
+	fmt = "%s: %s made %d status changes to %d tickets"
+	com.log.info(fmt % (f, user, len(rows), len(tids)))
+
+	data = "\n".join(out)
+	req.send_response(200)
+	req.send_header('Content-Type', 'plain/text')
+	req.send_header('Content-Length', len(data))
+	req.write(data)
+	req.write('\n')
+	raise RequestDone
+
 def is_shipdate(req):
 	'''
 		/ebs/mark/shipdate/Event%20Demo
@@ -1335,13 +2475,28 @@ def is_shipdate(req):
 	a = req.path_info.strip('/').split('/')
 	return len(a) == 4 and a[2] == 'shipdate'
 
-def extract_dev_hrs(req):
+def is_shipdates(req):
+	'''
+		/ebs/mark/shipdates
+		/ebs/mark/shipdates/
+		/ebs/mark/shipdates?mark=8
+	'''
+	a = req.path_info.strip('/').split('/')
+	return len(a) == 3 and a[2].split('?')[0] == 'shipdates'
+
+# Query arguments that are not developer names.
+reserved_args = ('seed',)
+
+def extract_args(req):
 	'''
+	Query arguments embedded in PATH_INFO.  (ebsls quotes the whole
+	resource, so the query string ends up in the path.)
+
 		>>> class T: pass
 		>>> t = T()
-		>>> t.path_info = '/test/Event%20Demo/%3fmark=8'
-		>>> extract_dev_hrs(t)
-		{'mark': 8.0}
+		>>> t.path_info = '/test/Event%20Demo/%3fmark=8&seed=42'
+		>>> sorted(extract_args(t).items())
+		[('mark', '8'), ('seed', '42')]
 
 	If invalid query argument, return an error.
 	'''
@@ -1356,13 +2511,148 @@ def extract_dev_hrs(req):
 		path, arglist = s.split('?')
 		args = arglist.split('&')
 		for arg in args:
-			dev, hrs = arg.split('=')
-			rval[dev] = string_to_float(hrs)
+			name, value = arg.split('=')
+			rval[name] = value
 	except Exception, e:
 		error(req, "Unexpected query string format: %s" % e)
 
 	return rval
 
+def extract_dev_hrs(req):
+	'''
+		>>> class T: pass
+		>>> t = T()
+		>>> t.path_info = '/test/Event%20Demo/%3fmark=8&seed=42'
+		>>> extract_dev_hrs(t)
+		{'mark': 8.0}
+
+	If invalid query argument, return an error.
+	'''
+
+	rval = {}
+	for dev, hrs in extract_args(req).items():
+		if dev not in reserved_args:
+			rval[dev] = string_to_float(hrs)
+	return rval
+
+def extract_seed(req, default=None):
+	'''
+	The seed query argument, as an int.  If there isn't one, return
+	default, or if that is None, a new random seed so that the report
+	can say how to reproduce it.
+
+		>>> class T: pass
+		>>> t = T()
+		>>> t.args = {}
+		>>> t.path_info = '/test/Event%20Demo/%3fmark=8&seed=42'
+		>>> extract_seed(t)
+		42
+	'''
+
+	s = extract_args(req).get('seed')
+	if s is None and req.args:
+		s = req.args.get('seed')
+	if s is None and default is not None:
+		return default
+	if s is None:
+		return random.randrange(2 ** 31)
+	try:
+		return int(s)
+	except ValueError:
+		error(req, "seed must be an integer, not '%s'" % s)
+
+def lookup_dailyworkhours(req, db, calendar, dev_hrs):
+	'''
+	Average hours per work day for each dev, from their timecards,
+	with any overrides from dev_hrs.
+	'''
+
+	timecards = lookup_timecards(req, db)
+	dev_to_dailyworkhours = \
+	    ebs.availability_from_timecards(timecards, calendar)
+	for dev in dev_to_dailyworkhours.keys():
+		if dev_hrs.has_key(dev):
+			dev_to_dailyworkhours[dev] = dev_hrs[dev]
+	return dev_to_dailyworkhours
+
+def shipdates_report(com, req, db, milestones, dev_hrs, seed):
+	'''
+	Forecast all the given milestones and return the lines of a
+	one-row-per-milestone report.
+
+	History, timecards and the calendar are loaded once, from one
+	snapshot of the database, and the simulations are spread across
+	[ebs] workers processes.
+	'''
+
+	begin_snapshot(com, db)
+	try:
+		milestone_to_todo, milestone_to_bad = lookup_todos(db,
+		    milestones)
+		history = lookup_history(db)
+		calendar = lookup_calendar(db)
+		dev_to_dailyworkhours = lookup_dailyworkhours(req, db,
+		    calendar, dev_hrs)
+	finally:
+		end_snapshot(com, db)
+
+	for milestone in milestone_to_bad.keys():
+		del milestone_to_todo[milestone]
+
+	forecasts, errors = ebs.forecast_milestones(history,
+	    milestone_to_todo, dev_to_dailyworkhours, calendar,
+	    workers = com.workers or None, engine = com.engine,
+	    batch_n = com.trials_batch, max_trials_n = com.trials_max,
+	    stable_n = com.trials_stable, seconds = com.time_budget,
+	    seed = seed, sketch_size = com.sketch_size or None)
+
+	a = []
+	a.append("Ship Dates for Milestones")
+	a.append("=====================================")
+	a.append("Generated on %s with seed %d" \
+	    % (datetime.now().strftime("%Y-%m-%d at %H:%M"), seed)
+	    )
+	a.append("")
+	a.append("    milestone            |  5'th pct  | 50'th pct  | 95'th pct  | trials")
+	a.append("    ---------------------+------------+------------+------------+-------")
+	for milestone in milestones:
+		if forecasts.has_key(milestone):
+			pdf, devs, trials_n, status = forecasts[milestone]
+			q05, q50, q95 = ebs.shipdate_percentiles(pdf)
+			if status == 'exact':
+				trials_n = '-'
+			a.append("    %-20s | %s | %s | %s | %6s  %s" % (
+			    milestone[:20], q05, q50, q95, trials_n, status))
+			continue
+		if milestone_to_bad.has_key(milestone):
+			msg = "ticket %d has actual hours but a zero " \
+			    "estimate" % milestone_to_bad[milestone][0]
+		elif errors.has_key(milestone):
+			msg = errors[milestone]
+		else:
+			msg = "no open tickets"
+		a.append("    %-20s | %s" % (milestone[:20], msg))
+	a.append("")
+
+	return a
+
+def get_shipdates(com, req):
+	'''Report the shipdate of every milestone that is not completed.'''
+	f = "get_shipdates"
+	if req.method != 'GET':
+		error(req, "%s: expected a GET" % f)
+
+	db = get_db(com, req)
+	milestones = lookup_active_milestones(db)
+	if not milestones:
+		error(req, "No open milestones.")
+
+	a = shipdates_report(com, req, db, milestones, extract_dev_hrs(req),
+	    extract_seed(req))
+
+	data = "\n".join(a)
+	send_data(req, data + '\n')
+
 def history_to_avgvelocity(history):
 	'''
 		>>> h = [
@@ -1392,6 +2682,40 @@ def history_to_avgvelocity(history):
 
 	return d
 
+def default_seed(milestone):
+	'''
+	The seed for a ship date report that isn't given one.  It is the
+	same for every report on the milestone, in every process, so
+	asking again gives the same report (and the same cache key).
+
+		>>> default_seed(u'Event Demo') == default_seed('Event Demo')
+		True
+		>>> default_seed('Event Demo') == default_seed('Beta')
+		False
+	'''
+
+	if isinstance(milestone, unicode):
+		milestone = milestone.encode('utf-8')
+	return int(md5(milestone).hexdigest()[:8], 16) % 2 ** 31
+
+def shipdate_key(com, milestone, dev_hrs, seed, fingerprint):
+	'''
+	Everything a ship date report depends on, bar today's date, as a
+	key for com.report_cache.
+
+		>>> class T: pass
+		>>> com = T()
+		>>> com.engine, com.trials_batch, com.trials_max = 'numpy', 100, 10000
+		>>> com.trials_stable, com.time_budget, com.sketch_size = 3, 10.0, 0
+		>>> shipdate_key(com, 'Event Demo', {'paul': 4.0, 'mark': 8.0},
+		...     42, (1284000000, 12))
+		('Event Demo', (('mark', 8.0), ('paul', 4.0)), 42, (1284000000, 12), 'numpy', 100, 10000, 3, 10.0, 0)
+	'''
+
+	return (milestone, tuple(sorted(dev_hrs.items())), seed, fingerprint,
+	    com.engine, com.trials_batch, com.trials_max, com.trials_stable,
+	    com.time_budget, com.sketch_size)
+
 def get_shipdate(com, req):
 	'''Report shipdate of hours and tickets across all users.'''
 	f = "get_shipdate"
@@ -1402,8 +2726,7 @@ def get_shipdate(com, req):
 	user = a[1]
 	milestone = a[3]
 
-	db = com.env.get_db_cnx()
-	cursor = db.cursor()
+	db = get_db(com, req)
 
 	if not milestone:
 		error(req, 'Invalid URL, no milestone given.')
@@ -1413,43 +2736,79 @@ def get_shipdate(com, req):
 	if '?' in milestone:
 		milestone = milestone.split('?')[0]
 
-	todo = lookup_todo(req, db, milestone)
+	dev_hrs = extract_dev_hrs(req)
+	seed = extract_seed(req, default_seed(milestone))
+
+	#
+	# If nothing has changed since we last made this report (with the
+	# same overrides and seed, today), send it again.
+	#
+
+	data = None
+	begin_snapshot(com, db)
+	try:
+		fingerprint = lookup_fingerprint(db)
+		check_modified(com, req, (fingerprint, date.today()))
+		key = shipdate_key(com, milestone, dev_hrs, seed, fingerprint)
+		data = com.report_cache.get(key)
+		if data is None:
+			todo = lookup_todo(req, db, milestone)
+		if data is None and todo:
+			history = lookup_history(db)
+			calendar = lookup_calendar(db)
+			dev_to_dailyworkhours = lookup_dailyworkhours(req, db,
+			    calendar, dev_hrs)
+	finally:
+		end_snapshot(com, db)
+
+	if data is not None:
+		com.log.debug("%s: cached report for '%s'" % (f, milestone))
+		send_data(req, data + '\n')
 
 	if not todo:
 		data = "No tasks assigned to Milestone '%s'\n" % milestone
-		req.send_response(200)
-		req.send_header('Content-Type', 'plain/text')
-		req.send_header('Content-Length', len(data))
-		req.write(data)
-		raise RequestDone
-
-	history = lookup_history(db)
-	timecards = lookup_timecards(req, db)
+		send_data(req, data)
 
-	dev_to_dailyworkhours = ebs.availability_from_timecards(timecards)
-	dev_hrs = extract_dev_hrs(req)
-	for dev in dev_to_dailyworkhours.keys():
-		if dev_hrs.has_key(dev):
-			dev_to_dailyworkhours[dev] = dev_hrs[dev]
+	#
+	# Keep each milestone's trials from one report to the next, so
+	# after a ticket changes we only re-run its owner's trials.  That
+	# only works with the same seed, which is why a report that isn't
+	# given one always uses the milestone's default_seed().
+	#
+	# We take the cache out while we use it; a request for the same
+	# milestone at the same time just starts from scratch.  Each
+	# process has its own, of up to cache_size milestones.
+	#
 
-	pdf_data, dev_data = \
-	    ebs.history_to_plotdata(history, todo, dev_to_dailyworkhours)
+	cache = None
+	if com.incremental:
+		last_seed, cache = com.forecast_cache.pop(milestone) \
+		    or (None, {})
+		if seed != last_seed:
+			cache = {}
+
+	pdf_data, dev_data, trials_n, status = ebs.history_to_forecast(
+	    history, todo, dev_to_dailyworkhours, engine = com.engine,
+	    calendar = calendar, batch_n = com.trials_batch,
+	    max_trials_n = com.trials_max, stable_n = com.trials_stable,
+	    seconds = com.time_budget, seed = seed,
+	    sketch_size = com.sketch_size or None, cache = cache)
+	if cache is not None:
+		com.forecast_cache.put(milestone, (seed, cache))
 	pdf_plot = plotter.pdf(pdf_data)
 
-	mindt = pdf_data[0][0]
-	days = [(dt - mindt).days for dt, density in pdf_data]
-	q05 = mindt + timedelta(ebs.percentile(days, 0.05))
-	q50 = mindt + timedelta(ebs.percentile(days, 0.50))
-	q95 = mindt + timedelta(ebs.percentile(days, 0.95))
+	q05, q50, q95 = ebs.shipdate_percentiles(pdf_data)
 
 	
 	a = []
 
 	a.append("Schedule for Milestone '%s'" % milestone)
 	a.append("=====================================")
-	a.append("Generated on %s" \
+	generated = "Generated on %s" \
 	    % datetime.now().strftime("%Y-%m-%d at %H:%M")
-	    )
+	if status != 'exact':
+		generated += " with seed %d" % seed
+	a.append(generated)
 	a.append("")
 
 	a.append("Probability Density of Ship Date")
@@ -1461,6 +2820,17 @@ def get_shipdate(com, req):
 	a.append("      50'th percentile = %s" % q50)
 	a.append("      95'th percentile = %s" % q95)
 	a.append("")
+	if status == 'exact':
+		a.append("Computed exactly, without sampling.")
+	elif status == 'converged':
+		a.append("Based on %d trials (converged)." % trials_n)
+	elif status == 'max trials':
+		a.append("Based on %d trials (not converged, hit the trial "
+		    "limit)." % trials_n)
+	else:
+		a.append("Based on %d trials (not converged, hit the time "
+		    "limit)." % trials_n)
+	a.append("")
 	a.append("")
 
 	dev_plot = plotter.box_and_whisker(dev_data)
@@ -1515,14 +2885,14 @@ def get_shipdate(com, req):
 
 
 	data = "\n".join(a)
-	req.send_response(200)
-	req.send_header('Content-Type', 'plain/text')
-	req.send_header('Content-Length', len(data))
-	req.write(data)
-	req.write('\n')
-	raise RequestDone
+	com.report_cache.put(key, data)
+	send_data(req, data + '\n')
 
 if __name__ == '__main__':
 	testing = True
 	import doctest
 	doctest.testmod()
+	doctest.testfile('clock.txt')
+	doctest.testfile('bulk.txt')
+	doctest.testfile('velocity.txt')
+	doctest.testfile('fingerprint.txt')
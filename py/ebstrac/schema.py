@@ -0,0 +1,275 @@
+# Database tables used by the evidence-based scheduling plugin.
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+import handlers
+
+# Row in Trac's system table that holds our schema version.
+version_name = 'ebs_version'
+
+#
+# Each entry in upgrades takes the schema up by one version.  An entry
+# is a list of steps, and a step is either a Table to create, or a
+# function f(env, db, cursor) for anything else (data migrations and
+# the like).
+#
+# Dates are stored as 'YYYY-MM-DD' strings, the same format we use for
+# backdated hours.  (Trac doesn't have a date column type.)
+#
+
+def backfill_timecards(env, db, cursor):
+	'''
+	Fill ebs_timecard from the hours already in ticket_change, and
+	return the number of rows.  Starts from scratch, so it is safe to
+	run again.
+	'''
+
+	cards = handlers.scan_timecards(db)
+	cursor.execute("DELETE FROM ebs_timecard")
+	cursor.executemany("INSERT INTO ebs_timecard "
+	    "(username, day, ticket, hours) VALUES (%s, %s, %s, %s)",
+	    [key + (hours,) for key, hours in cards.items()])
+	return len(cards)
+
+def rebuild_velocity(env, db, cursor):
+	'''
+	Fill ebs_velocity from the closed tickets, and return the number
+	of rows.  Starts from scratch, so it is safe to run again.
+	'''
+
+	history = handlers.scan_history(cursor)
+	cursor.execute("DELETE FROM ebs_velocity")
+	cursor.executemany("INSERT INTO ebs_velocity "
+	    "(owner, ticket, est, act, velocity, closed_at) "
+	    "VALUES (%s, %s, %s, %s, %s, %s)", history)
+	return len(history)
+
+def fix_velocity_times(env, db, cursor):
+	'''
+	Version 3 copied Trac's close times into ebs_velocity as they
+	were, and Trac 0.12 and later keep them in microseconds.  Put them
+	in seconds, like the rest, and return the number of rows changed.
+	'''
+
+	cursor.execute("SELECT ticket, closed_at FROM ebs_velocity "
+	    "WHERE closed_at >= %s", (handlers.seconds_max,))
+	rows = [(tm // 1000000, tid) for tid, tm in cursor.fetchall()]
+	cursor.executemany("UPDATE ebs_velocity SET closed_at = %s "
+	    "WHERE ticket = %s", rows)
+	return len(rows)
+
+def backfill_comments(env, db, cursor):
+	'''
+	Fill ebs_comment with the last comment number on each ticket, and
+	return the number of rows.  Starts from scratch, so it is safe to
+	run again.
+	'''
+
+	d = handlers.scan_comments(cursor)
+	cursor.execute("DELETE FROM ebs_comment")
+	cursor.executemany("INSERT INTO ebs_comment (ticket, cnum) "
+	    "VALUES (%s, %s)", d.items())
+	return len(d)
+
+def import_wiki_clocks(env, db, cursor):
+	'''
+	Move the running clocks from the wiki page they used to be kept in
+	into ebs_clock, and delete the page.  Return the number of clocks.
+	'''
+
+	clocks = handlers.scan_wiki_clocks(cursor)
+	cursor.executemany("INSERT INTO ebs_clock "
+	    "(username, ticket, started_at) VALUES (%s, %s, %s)", clocks)
+	cursor.execute("DELETE FROM wiki WHERE name = %s",
+	    (handlers.magicname,))
+	return len(clocks)
+
+upgrades = [
+
+	# 1: company holidays and per-dev absences.
+	[
+		Table('ebs_holiday', key='day')[
+			Column('day'),
+			Column('name'),
+		],
+
+		# hours is the number of hours off that day; NULL means
+		# the whole day.
+		Table('ebs_absence', key=('username', 'day'))[
+			Column('username'),
+			Column('day'),
+			Column('hours', type='real'),
+			Index(['day']),
+		],
+	],
+
+	# 2: hours worked by each user, each day, on each ticket.  Kept
+	# up to date as hours are posted, so we don't have to work it
+	# out from ticket_change for every forecast.
+	[
+		Table('ebs_timecard', key=('username', 'day', 'ticket'))[
+			Column('username'),
+			Column('day'),
+			Column('ticket', type='int'),
+			Column('hours', type='real'),
+		],
+		backfill_timecards,
+	],
+
+	# 3: estimate, actual hours and velocity of each ticket closed as
+	# fixed, and when it was closed (in seconds).  Kept up to date as
+	# tickets change, so a forecast doesn't have to cast every
+	# estimate and actual in ticket_custom.
+	[
+		Table('ebs_velocity', key='ticket')[
+			Column('owner'),
+			Column('ticket', type='int'),
+			Column('est', type='real'),
+			Column('act', type='real'),
+			Column('velocity', type='real'),
+			Column('closed_at', type='int'),
+			Index(['owner', 'closed_at']),
+			Index(['closed_at']),
+		],
+		rebuild_velocity,
+	],
+
+	# 4: the last comment number used on each ticket, so a new one
+	# doesn't need a scan of the ticket's changes.
+	[
+		Table('ebs_comment', key='ticket')[
+			Column('ticket', type='int'),
+			Column('cnum', type='int'),
+		],
+		backfill_comments,
+	],
+
+	# 5: each user's running clock: the ticket, and when it started
+	# (in seconds).  No row means no clock.  These used to be lines
+	# in the EvidenceBasedSchedulingTimeClockPage wiki page.
+	[
+		Table('ebs_clock', key='username')[
+			Column('username'),
+			Column('ticket', type='int'),
+			Column('started_at', type='int'),
+		],
+		import_wiki_clocks,
+	],
+
+	# 6: ebs_velocity close times all in seconds.
+	[
+		fix_velocity_times,
+	],
+]
+
+version = len(upgrades)
+
+#
+# Indexes we add to Trac's own tables, for the queries we run all the
+# time.  Stock Trac only indexes ticket_change on ticket and on time,
+# so without these they are full scans of ticket_change.
+#
+# These aren't versioned like our tables: a Trac upgrade can rebuild
+# its tables and drop them, so we check for them every time Trac asks
+# whether the environment needs upgrading, and upgrade() creates any
+# that are missing.  Only SQLite and PostgreSQL are checked.
+#
+indexes = (
+	# Every hours change, in time order (scan_timecards()).
+	('ebs_ticket_change_field_time', 'ticket_change', ('field', 'time')),
+
+	# One user's hours changes, in time order (get_log()).
+	('ebs_ticket_change_author', 'ticket_change',
+	    ('author', 'field', 'time')),
+
+	# The last comment number on a ticket (the max(oldvalue) lookups
+	# when we post hours, estimates and status).
+	('ebs_ticket_change_ticket_field', 'ticket_change',
+	    ('ticket', 'field')),
+
+	# One custom field for every ticket (estimates and actuals).
+	('ebs_ticket_custom_name', 'ticket_custom', ('name', 'ticket')),
+)
+
+def get_indexes(env, db):
+	'''
+	Return the names of the indexes on the tables in indexes, or None
+	if we don't know how to ask this kind of database.
+	'''
+
+	tables = sorted(set([table for name, table, columns in indexes]))
+	scheme = env.config.get('trac', 'database').split(':')[0]
+	if scheme == 'sqlite':
+		sql = "SELECT name FROM sqlite_master " \
+		    + "WHERE type = 'index' AND tbl_name IN (%s)"
+	elif scheme == 'postgres':
+		sql = "SELECT indexname FROM pg_indexes " \
+		    + "WHERE tablename IN (%s)"
+	else:
+		return None
+	cursor = db.cursor()
+	cursor.execute(sql % ", ".join(["%s"] * len(tables)), tables)
+	return set([row[0] for row in cursor.fetchall()])
+
+def missing_indexes(env, db):
+	'''The entries in indexes that aren't in the database.'''
+
+	have = get_indexes(env, db)
+	if have is None:
+		return []
+	return [x for x in indexes if x[0] not in have]
+
+def create_indexes(env, db, cursor):
+	'''Create any missing indexes, and return their names.'''
+
+	a = []
+	for name, table, columns in missing_indexes(env, db):
+		cursor.execute("CREATE INDEX %s ON %s (%s)"
+		    % (name, table, ", ".join(columns)))
+		a.append(name)
+	return a
+
+def get_version(db):
+	'''Return the installed schema version, 0 if none.'''
+
+	cursor = db.cursor()
+	cursor.execute("SELECT value FROM system WHERE name = %s",
+	    (version_name,))
+	row = cursor.fetchone()
+	if not row:
+		return 0
+	return int(row[0])
+
+def needs_upgrade(env, db):
+	return get_version(db) < version or bool(missing_indexes(env, db))
+
+def upgrade(env, db):
+	'''
+	Bring the schema up to date.  Does not commit; that is up to the
+	caller (Trac commits after upgrade_environment()).
+	'''
+
+	for name in create_indexes(env, db, db.cursor()):
+		env.log.info("Created index %s" % name)
+
+	current = get_version(db)
+	if current >= version:
+		return
+
+	connector, args = DatabaseManager(env)._get_connector()
+	cursor = db.cursor()
+	for steps in upgrades[current:]:
+		for step in steps:
+			if isinstance(step, Table):
+				for sql in connector.to_sql(step):
+					cursor.execute(sql)
+			else:
+				step(env, db, cursor)
+
+	if current == 0:
+		sql = "INSERT INTO system (value, name) VALUES (%s, %s)"
+	else:
+		sql = "UPDATE system SET value = %s WHERE name = %s"
+	cursor.execute(sql, (str(version), version_name))
+	env.log.info("Upgraded EBS schema from version %d to %d"
+	    % (current, version))